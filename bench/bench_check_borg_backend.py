@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# coding: utf8
+# -----------------------------------------------------------------
+# benchmark check_borg.py backends on a local test repository
+# - subprocess: borg list then borg info commands
+# - api: borg python API, one repository open
+#
+# needs borg installed (command and python package)
+# -----------------------------------------------------------------
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+parser = argparse.ArgumentParser(
+    description='benchmark check_borg.py subprocess and API backends')
+parser.add_argument("--archives",
+                    type=int,
+                    help="number of archives in the test repository",
+                    default=20)
+parser.add_argument("--runs",
+                    type=int,
+                    help="number of runs per backend",
+                    default=5)
+args = parser.parse_args()
+
+plugin = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "..", "bin", "check_borg.py")
+
+try:
+    import borg
+except ImportError:
+    print("borg python package not installed, benchmark skipped")
+    exit(1)
+
+
+#
+# best wall clock time of a plugin command line
+#
+def bench(options, environment):
+    best = None
+    for run in range(args.runs):
+        start = time.perf_counter()
+        output = subprocess.check_output(
+            [sys.executable, plugin] + options,
+            env=environment).decode()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, output.split("|")[0].strip()
+
+
+with tempfile.TemporaryDirectory() as directory:
+    environment = dict(os.environ)
+    environment["HOME"] = directory
+    environment["BORG_UNKNOWN_UNENCRYPTED_REPO_ACCESS_IS_OK"] = "yes"
+    repository = os.path.join(directory, "repo")
+    data = os.path.join(directory, "data")
+
+    #
+    # test repository with a few MB of data per archive
+    #
+    subprocess.check_call(["borg", "init", "-e", "none", repository],
+                          env=environment)
+    os.makedirs(data)
+    for index in range(args.archives):
+        with open(os.path.join(data, "file%d" % index), "wb") as fd_data:
+            fd_data.write(os.urandom(1024 * 1024))
+        subprocess.check_call(
+            ["borg", "create", "%s::bench_%04d" % (repository, index), data],
+            env=environment)
+
+    print("%d archives, best of %d runs" % (args.archives, args.runs))
+    for backend in ("subprocess", "api"):
+        elapsed, output = bench(
+            ["--backend", backend, "--include", "^bench_", "--timings",
+             repository],
+            environment)
+        print("%-12s %8.1f ms  %s" % (backend, elapsed * 1000, output))
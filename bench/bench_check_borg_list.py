@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# coding: utf8
+# -----------------------------------------------------------------
+# benchmark check_borg.py archive listing
+# - regex over borg list text output
+# - borg list --json, full listing and filtered by borg
+#
+# a fake borg command replays a synthetic listing, so only the
+# plugin side of the listing is measured
+# -----------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import datetime
+import argparse
+import tempfile
+import subprocess
+
+parser = argparse.ArgumentParser(
+    description='benchmark check_borg.py archive listing')
+parser.add_argument("--archives",
+                    type=int,
+                    help="number of synthetic archives",
+                    default=10000)
+parser.add_argument("--runs",
+                    type=int,
+                    help="number of runs per mode",
+                    default=5)
+args = parser.parse_args()
+
+plugin = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "..", "bin", "check_borg.py")
+
+fake_borg = """#!/bin/sh
+case "$*" in
+    *--last*) cat "%(dir)s/list_last.json" ;;
+    *--json*) cat "%(dir)s/list.json" ;;
+    list*) cat "%(dir)s/list.txt" ;;
+    info*) cat "%(dir)s/info.txt" ;;
+esac
+"""
+
+info = """Archive name: bench
+This archive:               10.00 GB              8.00 GB            100.00 MB
+All archives:              500.00 GB            400.00 GB             50.00 GB
+"""
+
+
+#
+# write synthetic listings for every mode
+#
+def build_listings(directory, count):
+    first = datetime.datetime.now() - datetime.timedelta(hours=count)
+    archives = []
+    with open(os.path.join(directory, "list.txt"), "w") as fd_text:
+        for index in range(count):
+            prefix = ("T410_", "www_", "db_")[index % 3]
+            date = first + datetime.timedelta(hours=index)
+            name = prefix + date.strftime('%Y-%m-%dT%H:%M:%S')
+            fd_text.write("%-36s %s\n" % (
+                name, date.strftime('%a, %Y-%m-%d %H:%M:%S')))
+            archives.append({
+                "archive": name,
+                "barchive": name,
+                "id": "%064x" % index,
+                "name": name,
+                "start": date.strftime('%Y-%m-%dT%H:%M:%S.000000'),
+                "time": date.strftime('%Y-%m-%dT%H:%M:%S.000000')
+            })
+
+    repository = {"id": "0" * 64, "last_modified": "", "location": "bench"}
+    with open(os.path.join(directory, "list.json"), "w") as fd_json:
+        json.dump({"archives": archives,
+                   "encryption": {"mode": "none"},
+                   "repository": repository},
+                  fd_json, sort_keys=True, indent=4)
+
+    last = [archive for archive in archives
+            if archive["name"].startswith("T410_")][-1:]
+    with open(os.path.join(directory, "list_last.json"), "w") as fd_json:
+        json.dump({"archives": last,
+                   "encryption": {"mode": "none"},
+                   "repository": repository},
+                  fd_json, sort_keys=True, indent=4)
+
+    with open(os.path.join(directory, "info.txt"), "w") as fd_info:
+        fd_info.write(info)
+
+    with open(os.path.join(directory, "borg"), "w") as fd_borg:
+        fd_borg.write(fake_borg % {"dir": directory})
+    os.chmod(os.path.join(directory, "borg"), 0o755)
+
+
+#
+# best wall clock time of a plugin command line
+#
+def bench(options, environment):
+    best = None
+    for run in range(args.runs):
+        start = time.perf_counter()
+        output = subprocess.check_output(
+            [sys.executable, plugin] + options + ["bench"],
+            env=environment).decode()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, output.split("|")[0].strip()
+
+
+with tempfile.TemporaryDirectory() as directory:
+    build_listings(directory, args.archives)
+    environment = dict(os.environ)
+    environment["PATH"] = directory + os.pathsep + environment["PATH"]
+
+    modes = (
+        ("regex", ["--include", "^T410_"]),
+        ("json", ["--json", "--include", "^T410_"]),
+        ("json --prefix --last 1",
+         ["--json", "--prefix", "T410_", "--last", "1"])
+    )
+    print("%d archives, best of %d runs" % (args.archives, args.runs))
+    for label, options in modes:
+        elapsed, output = bench(options, environment)
+        print("%-24s %8.1f ms  %s" % (label, elapsed * 1000, output))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# coding: utf8
+# -----------------------------------------------------------------
+# benchmark check_borg_log.py log parsing
+# - legacy full read with one regex search per field over the whole
+#   buffer (first match: the oldest run of the log is reported)
+# - single pass scan of the whole log (--history)
+# - last run read from the end of the log (default mode)
+#
+# a synthetic borg create log with file lists between runs is
+# generated, wall clock time and max resident memory are reported
+# -----------------------------------------------------------------
+
+import os
+import sys
+import time
+import datetime
+import argparse
+import tempfile
+import subprocess
+
+parser = argparse.ArgumentParser(
+    description='benchmark check_borg_log.py log parsing')
+parser.add_argument("--size",
+                    type=int,
+                    help="synthetic log size in MB",
+                    default=256)
+parser.add_argument("--files",
+                    type=int,
+                    help="number of file lines per run",
+                    default=200)
+args = parser.parse_args()
+
+plugin = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "..", "bin", "check_borg_log.py")
+
+run_text = """------------------------------------------------------------------------------
+Archive name: T410_%(name)s
+Archive fingerprint: 0123456789abcdef0123456789abcdef
+Time (start): %(start)s
+Time (end):   %(end)s
+Duration: 10 minutes 0.00 seconds
+Number of files: %(files)d
+------------------------------------------------------------------------------
+                       Original size      Compressed size    Deduplicated size
+This archive:               10.00 GB              8.00 GB            %(dsize)d.00 MB
+All archives:              %(gosize)d.00 GB            400.00 GB             %(gdsize)d.00 GB
+
+                       Unique chunks         Total chunks
+Chunk index:                   12345               123456
+------------------------------------------------------------------------------
+"""
+
+#
+# parsing as done before the single pass scanner: whole file read,
+# one search per field regex over the whole buffer
+#
+legacy = r"""
+import re, sys
+re_name = re.compile("Archive name: (.*)")
+re_start_date = re.compile(
+    "Time\s\(start\):\s*(\S*)\s*.*, (....-..-.. ..:..:..)")
+re_end_date = re.compile(
+    "Time\s\(end\):\s*(\S*)\s*.*, (....-..-.. ..:..:..)")
+re_archive = re.compile(
+    "This archive:\s*(\S*)\s(..)\s*(\S*)\s(..)\s*(\S*)\s(..)")
+re_global = re.compile(
+    "All archives:\s*(\S*)\s(..)\s*(\S*)\s(..)\s*(\S*)\s(..)")
+fd_borg_log = open(sys.argv[1], "r")
+borg_log_data = fd_borg_log.read()
+run = [regex.search(borg_log_data).groups()
+       for regex in (re_name, re_start_date, re_end_date, re_archive,
+                     re_global)]
+fd_borg_log.close()
+print(run[0][0])
+"""
+
+
+#
+# write a synthetic log of about size MB
+#
+def build_log(path, size, files):
+    first = datetime.datetime(2020, 1, 1, 2, 0, 0)
+    file_lines = "".join(
+        "A /home/user/documents/file%06d.txt\n" % index
+        for index in range(files))
+    index = 0
+    with open(path, "w") as fd_log:
+        while fd_log.tell() < size * 1024**2:
+            start = first + datetime.timedelta(hours=index)
+            end = start + datetime.timedelta(minutes=10 + index % 7)
+            fd_log.write(file_lines)
+            fd_log.write(run_text % {
+                "name": start.strftime('%Y-%m-%dT%H:%M:%S'),
+                "start": start.strftime('%a, %Y-%m-%d %H:%M:%S'),
+                "end": end.strftime('%a, %Y-%m-%d %H:%M:%S'),
+                "files": files,
+                "dsize": 100 + index % 50,
+                "gosize": 500 + index,
+                "gdsize": 50 + index
+            })
+            index += 1
+    return index
+
+
+#
+# wall clock time and max resident memory of a command line
+#
+def bench(command):
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    output = process.stdout.read().decode()
+    pid, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    return elapsed, usage.ru_maxrss, output.split("|")[0].strip()
+
+
+with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, "borg.log")
+    runs = build_log(path, args.size, args.files)
+
+    modes = (
+        ("legacy full read", [sys.executable, "-c", legacy, path]),
+        ("single pass scan",
+         [sys.executable, plugin, "--history", "--window", "100000", path]),
+        ("last run from end", [sys.executable, plugin, path])
+    )
+    print("%d MB log, %d runs" % (os.path.getsize(path) // 1024**2, runs))
+    for label, command in modes:
+        elapsed, maxrss, output = bench(command)
+        print("%-20s %8.1f ms %8d kB  %s" % (
+            label, elapsed * 1000, maxrss, output[:60]))
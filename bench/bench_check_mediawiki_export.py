@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# coding: utf8
+# -----------------------------------------------------------------
+# benchmark check_mediawiki_export.py directory scan
+# - legacy listdir loop: isfile, getsize, getctime, regex and
+#   datetime for every entry
+# - scandir scan: suffix test, one stat, integer ns timestamps
+# - manifest rescan: scandir scan diffed with the export manifest
+# - manifest unchanged: directory mtime unchanged, listing skipped
+#
+# a synthetic export directory of wikitext pages (and a few other
+# files) is generated, best wall clock time of each scan is reported
+# -----------------------------------------------------------------
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+parser = argparse.ArgumentParser(
+    description='benchmark check_mediawiki_export.py directory scan')
+parser.add_argument("--files",
+                    type=int,
+                    help="number of synthetic page files",
+                    default=500000)
+parser.add_argument("--runs",
+                    type=int,
+                    help="number of runs per scan",
+                    default=3)
+args = parser.parse_args()
+
+plugin = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "..", "bin", "check_mediawiki_export.py")
+
+#
+# scan as done before scandir
+#
+legacy = """
+import os, re, sys, datetime
+re_wikitext = re.compile(".*\\\\.wikitext$")
+pages = size = 0
+last = datetime.datetime.strptime('1970-01-01', '%Y-%m-%d')
+for filename in os.listdir(sys.argv[1]):
+    filepath = os.path.join(sys.argv[1], filename)
+    if os.path.isfile(filepath):
+        filesize = os.path.getsize(filepath)
+        filedate = datetime.datetime.fromtimestamp(os.path.getctime(filepath))
+        if filesize and re_wikitext.match(filename):
+            pages += 1
+            size += filesize
+            if filedate > last:
+                last = filedate
+print("pages: %d size: %d" % (pages, size))
+"""
+
+
+#
+# write page files, one non page file every 100 pages
+#
+def build_export(directory, count):
+    content = b"== Page ==\nSome wikitext content.\n"
+    for index in range(count):
+        with open(os.path.join(directory, "Page_%07d.wikitext" % index),
+                  "wb") as fd_page:
+            fd_page.write(content)
+        if index % 100 == 0:
+            with open(os.path.join(directory, "Page_%07d.json" % index),
+                      "wb") as fd_other:
+                fd_other.write(b"{}")
+
+
+#
+# best wall clock time of a command line
+#
+def bench(command):
+    best = None
+    for run in range(args.runs):
+        start = time.perf_counter()
+        output = subprocess.run(command, stdout=subprocess.PIPE).stdout
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, output.decode().split("|")[0].strip()
+
+
+with tempfile.TemporaryDirectory() as directory, \
+        tempfile.TemporaryDirectory() as cachedir:
+    build_export(directory, args.files)
+
+    modes = (
+        ("legacy listdir", [sys.executable, "-c", legacy, directory]),
+        ("scandir", [sys.executable, plugin, directory]),
+        ("manifest rescan", [sys.executable, plugin, "--cachedir", cachedir,
+                             "--rescan", directory]),
+        ("manifest unchanged", [sys.executable, plugin, "--cachedir",
+                                cachedir, directory])
+    )
+    print("%d pages, best of %d runs" % (args.files, args.runs))
+    for label, command in modes:
+        elapsed, output = bench(command)
+        print("%-18s %8.1f ms  %s" % (label, elapsed * 1000, output[-60:]))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# coding: utf8
+# -----------------------------------------------------------------
+# benchmark check_sqlite.py integrity check connection profiles
+# - default read only connection (mode=ro, default pragmas)
+# - verification profile: immutable=1, mmap_size, large cache_size
+#
+# a synthetic MediaWiki like database is generated, integrity_check
+# and quick_check wall clock time and throughput are reported
+# -----------------------------------------------------------------
+
+import os
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+
+parser = argparse.ArgumentParser(
+    description='benchmark check_sqlite.py integrity check profiles')
+parser.add_argument("--size",
+                    type=int,
+                    help="synthetic database size in MB",
+                    default=1024)
+parser.add_argument("--runs",
+                    type=int,
+                    help="number of runs per profile",
+                    default=3)
+parser.add_argument("--cachesize",
+                    type=int,
+                    help="page cache MB of the verification profile",
+                    default=256)
+args = parser.parse_args()
+
+
+#
+# database of about size MB: page, revision and text tables with indexes
+#
+def build_database(path, size):
+    conn = sqlite3.connect(path)
+    conn.execute("pragma journal_mode=off")
+    conn.execute("pragma synchronous=off")
+    conn.execute("create table page (page_id integer primary key, "
+                 "page_title text, page_len integer)")
+    conn.execute("create table revision (rev_id integer primary key, "
+                 "rev_page integer, rev_timestamp text, rev_len integer)")
+    conn.execute("create table text (old_id integer primary key, "
+                 "old_text blob)")
+    conn.execute("create index page_title on page (page_title)")
+    conn.execute("create index rev_page on revision (rev_page, rev_timestamp)")
+    random.seed(0)
+    index = 0
+    while os.path.getsize(path) < size * 1024**2:
+        rows = range(index, index + 10000)
+        conn.executemany("insert into page values (?, ?, ?)", (
+            (row, "Page_%d_%d" % (row, random.getrandbits(32)), 2000)
+            for row in rows))
+        conn.executemany("insert into revision values (?, ?, ?, ?)", (
+            (row, random.randrange(index + 1), "2026%010d" % row, 2000)
+            for row in rows))
+        conn.executemany("insert into text values (?, ?)", (
+            (row, random.randbytes(random.randrange(500, 3000)))
+            for row in rows))
+        conn.commit()
+        index += 10000
+    conn.close()
+
+
+def connect_default(path):
+    return sqlite3.connect("file:" + path + "?mode=ro", uri=True)
+
+
+def connect_verification(path):
+    conn = sqlite3.connect("file:" + path + "?mode=ro&immutable=1", uri=True)
+    conn.execute("pragma mmap_size=%d;" % os.path.getsize(path))
+    conn.execute("pragma cache_size=%d;" % -(args.cachesize * 1024))
+    return conn
+
+
+#
+# best wall clock time of a pragma with a connection profile
+#
+def bench(path, connect, pragma):
+    best = None
+    for run in range(args.runs):
+        start = time.perf_counter()
+        conn = connect(path)
+        result = conn.execute("pragma %s;" % pragma).fetchall()
+        conn.close()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result[0][0]
+
+
+with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, "bench.sqlite")
+    build_database(path, args.size)
+    size = os.path.getsize(path) / 1024**2
+    print("%d MB database, best of %d runs (warm page cache)" % (
+        size, args.runs))
+    for pragma in ("integrity_check", "quick_check"):
+        for label, connect in (("default", connect_default),
+                               ("verification", connect_verification)):
+            elapsed, result = bench(path, connect, pragma)
+            print("%-16s %-13s %8.1f ms %8.1f MB/s  %s" % (
+                pragma, label, elapsed * 1000, size / elapsed, result))
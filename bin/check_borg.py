@@ -7,14 +7,25 @@
 # Copyright (C) 2016-2017, Christophe Fauchard
 # -----------------------------------------------------------------
 
-__version_info__ = (0, 2, 0, 'b1')
+__version_info__ = (0, 10, 0, 'b1')
 __version__ = '.'.join(map(str, __version_info__))
 
+import io
 import os
 import re
+import sys
+import json
+import fcntl
+import signal
+import threading
+import contextlib
+import time
 import datetime
 import argparse
+import tempfile
 import subprocess
+import configparser
+import concurrent.futures
 
 parser = argparse.ArgumentParser(
     description='check Borg backups for Nagios with perfdatas for size')
@@ -50,13 +61,77 @@ parser.add_argument("--include",
                     type=str,
                     help="include regex",
                     default="\.*")
+parser.add_argument("--pattern",
+                    action='append',
+                    help="named include regex NAME=REGEX, may be repeated, "
+                    "all patterns are evaluated from one borg list")
+parser.add_argument("--json",
+                    action='store_true',
+                    help="use borg list --json, filtered by borg")
+parser.add_argument("--prefix",
+                    type=str,
+                    help="archive name prefix, filtered by borg (--json)")
+parser.add_argument("--glob",
+                    type=str,
+                    help="archive name glob, filtered by borg (--json)")
+parser.add_argument("--last",
+                    type=int,
+                    help="only list the last N archives (--json)")
 parser.add_argument("--home",
                     type=str,
                     help="setting home directory for sudo calls")
+parser.add_argument("--lockwait",
+                    type=int,
+                    help="seconds borg waits for the repository lock, "
+                    "a locked repository returns the cached result",
+                    default=1)
+parser.add_argument("--backend",
+                    choices=["subprocess", "api"],
+                    help="borg commands or borg python API (one repository "
+                    "open, local repositories, falls back to subprocess)",
+                    default="subprocess")
+parser.add_argument("--deadline",
+                    type=int,
+                    help="max seconds for each borg process, its process "
+                    "group is killed and the check returns UNKNOWN")
+parser.add_argument("--timings",
+                    action='store_true',
+                    help="phase timings in perfdata (lock_ms, list_ms, "
+                    "info_ms, parse_ms)")
+parser.add_argument("--refreshwait",
+                    type=int,
+                    help="max seconds the background refresh waits for "
+                    "the repository lock",
+                    default=14400)
+parser.add_argument("--refresh",
+                    type=str,
+                    help=argparse.SUPPRESS)
+parser.add_argument("--cachedir",
+                    type=str,
+                    help="state directory, skip borg calls while the "
+                    "repository is unchanged")
+parser.add_argument("--config",
+                    type=str,
+                    help="configuration file listing several repositories")
+parser.add_argument("--workers",
+                    type=int,
+                    help="max repositories checked concurrently (--config)")
+parser.add_argument("--passive",
+                    type=str,
+                    help="Nagios command file, submit one passive result "
+                    "per repository (--config)")
 parser.add_argument('repository',
+                    nargs='?',
                     help="Borg backup repository")
 args = parser.parse_args()
 
+if not args.repository and not args.config and not args.refresh:
+    parser.error("a repository or --config is required")
+
+for pattern in args.pattern or []:
+    if "=" not in pattern:
+        parser.error("pattern %s is not NAME=REGEX" % pattern)
+
 
 def iso8601(value):
     # split seconds to larger units
@@ -118,99 +193,371 @@ def bytes_fmt(text_value, unit):
     elif unit == "TB":
         return(value * 1024**4)
 
-limitbackupagec = datetime.timedelta(hours=args.delayc)
-limitbackupagew = datetime.timedelta(hours=args.delayw)
+#
+# Repository transaction markers
+# (None for remote or unreadable repositories)
+#
+def repository_markers(repository):
+    transaction = -1
+    try:
+        config_mtime = os.stat(os.path.join(repository, "config")).st_mtime_ns
+        for filename in os.listdir(repository):
+            match_transaction = re_transaction.match(filename)
+            if match_transaction:
+                transaction = max(transaction,
+                                  int(match_transaction.group(2)))
+    except OSError:
+        return None
 
-re_sql = re.compile(".*\.sqlite$")
-re_include = re.compile(args.include)
-re_date = re.compile("(\S*)\s*.*, (....-..-.. ..:..:..)$")
-re_archive = re.compile("^This archive:\s*(\S*)\s(..)\s*(\S*)\s(..)\s*(\S*)\s(..)$")
-re_global = re.compile("^All archives:\s*(\S*)\s(..)\s*(\S*)\s(..)\s*(\S*)\s(..)$")
-                        
-lastbackupdate = datetime.datetime.strptime('1970-01-01', '%Y-%m-%d')
-cr = 2
+    return {"transaction": transaction, "config": config_mtime}
 
-try:
 
-    #
-    # Setting HOME environment variable for sudo calls
-    #
-    if args.home:
-        os.environ['HOME'] = args.home
+#
+# State file path for a repository
+#
+def state_path(cachedir, repository):
+    return os.path.join(
+        cachedir,
+        re.sub("[^A-Za-z0-9_.-]", "_", repository.strip("/")) + ".json")
 
-    #
-    # test borg lock time
-    #
-    if args.mintime:
-        if datetime.datetime.now().hour >= args.mintime and datetime.datetime.now().hour < args.maxtime:
-            exit(0)
-        
-    #
-    # Openning Borg list process
-    #
-    borg_list_process = subprocess.Popen(
+
+#
+# Load state file, empty state if missing or unreadable
+#
+def load_state(path):
+    try:
+        with open(path, "r") as fd_state:
+            return json.load(fd_state)
+    except (OSError, ValueError):
+        return {}
+
+
+#
+# Save state file atomically
+#
+def save_state(path, state):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd_temp, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd_temp, "w") as fd_state:
+        json.dump(state, fd_state)
+    os.replace(temp_path, path)
+
+
+#
+# Borg could not get the repository lock
+#
+class RepositoryLocked(Exception):
+    pass
+
+
+#
+# Borg python API error (missing repository, passphrase, cache...)
+#
+class BorgError(Exception):
+    pass
+
+
+#
+# Local repository exclusive lock (borg create, prune, check...)
+#
+def repository_locked(repository):
+    return os.path.isdir(os.path.join(repository, "lock.exclusive"))
+
+
+#
+# Borg lock time window (--mintime/--maxtime hours), --mintime 0
+# disables the window
+#
+def lock_window():
+    if not args.mintime:
+        return False
+    hour = datetime.datetime.now().hour
+    return hour >= args.mintime and hour < args.maxtime
+
+
+#
+# Borg process killed after --deadline seconds
+#
+class DeadlineExceeded(Exception):
+    pass
+
+
+#
+# Add elapsed wall clock time to a phase timing
+#
+def phase_time(options, phase, start):
+    options.phases[phase] = \
+        options.phases.get(phase, 0) + time.perf_counter() - start
+
+
+#
+# Start a borg process in its own process group, killed with the
+# whole group after --deadline seconds, stderr kept in a temporary
+# file so a long error output never blocks borg while stdout is read
+#
+def borg_popen(command, options, phase):
+    errors = tempfile.TemporaryFile()
+    borg_process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=errors,
+        start_new_session=True)
+    borg_process.errors = errors
+    borg_process.phase = phase
+    borg_process.expired = False
+    borg_process.watchdog = None
+
+    if options.deadline:
+        def kill_group():
+            borg_process.expired = True
+            try:
+                os.killpg(borg_process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        borg_process.watchdog = threading.Timer(options.deadline, kill_group)
+        borg_process.watchdog.start()
+
+    return borg_process
+
+
+#
+# Wait end of borg process, raise DeadlineExceeded when killed by
+# the watchdog and RepositoryLocked on lock timeout
+#
+def borg_wait(borg_process):
+    if not borg_process.stdout.closed:
+        borg_process.stdout.read()
+        borg_process.stdout.close()
+    borg_process.wait()
+    borg_process.errors.seek(0)
+    errors = str(borg_process.errors.read(), 'utf-8', 'replace')
+    borg_process.errors.close()
+    if borg_process.watchdog:
+        borg_process.watchdog.cancel()
+    if borg_process.expired:
+        raise DeadlineExceeded(borg_process.phase)
+    if borg_process.returncode != 0:
+        if args.verbose:
+            print("borg error: " + errors)
+        if re_lock_error.search(errors):
+            raise RepositoryLocked(errors.strip())
+
+
+#
+# Named include regex list, one unnamed pattern for --include
+#
+def archive_patterns(options):
+    if options.pattern:
+        return [
+            (pattern.split("=", 1)[0], re.compile(pattern.split("=", 1)[1]))
+            for pattern in options.pattern
+        ]
+    return [("", re.compile(options.include))]
+
+
+#
+# Search newest archive of each pattern with borg list,
+# returns {pattern name: (archive name, archive date, archive id)}
+#
+def borg_list(repository, options):
+    if options.json:
+        return borg_list_json(repository, options)
+
+    patterns = archive_patterns(options)
+    newest = {}
+
+    first_output = True
+    list_start = time.perf_counter()
+    borg_list_process = borg_popen(
         [
             "borg",
             "list",
-            args.repository
+            "--lock-wait",
+            str(options.lockwait),
+            repository
         ],
-        stdout=subprocess.PIPE)
+        options,
+        "borg list")
 
-    #
-    # read pipe for borg list
-    #
     for buffer in borg_list_process.stdout:
+        parse_start = time.perf_counter()
 
         #
-        # convert bytes array to string
+        # lock and manifest load until first output
         #
-        line = str(buffer, 'utf-8')
+        if first_output:
+            phase_time(options, "lock", list_start)
+            list_start = parse_start
+            first_output = False
 
         #
-        # test include regex
+        # convert bytes array to string
         #
-        if re_include and not re_include.match(line):
-            if args.verbose:
-                print("backup excluded: ", line)
-        else:
-            match_date = re_date.match(line)
-            if match_date:
+        line = str(buffer, 'utf-8')
+        match_date = None
+
+        for pattern_name, re_include in patterns:
+
+            #
+            # test include regex
+            #
+            if not re_include.match(line):
+                if args.verbose:
+                    print("backup excluded %s: %s" % (pattern_name, line))
+                continue
+
+            if match_date is None:
+                match_date = re_date.match(line)
+                if not match_date:
+                    break
                 backupname = match_date.group(1)
                 backupdate = datetime.datetime.strptime(
                     match_date.group(2),
                     '%Y-%m-%d %H:%M:%S')
-                backupage = datetime.datetime.now() - backupdate
 
-                #
-                # this is the last backup
-                #
-                if backupdate > lastbackupdate:
-                    lastbackupname = backupname
-                    lastbackupdate = backupdate
-                    lastbackupage = backupage
+            #
+            # this is the last backup
+            #
+            if pattern_name not in newest or \
+                    backupdate > newest[pattern_name][1]:
+                newest[pattern_name] = (backupname, backupdate, None)
+
+            else:
+                if args.verbose:
+                    print("not newest backup: " + backupname)
+
+        phase_time(options, "parse", parse_start)
+
+    phase_time(options, "list", list_start)
+    borg_wait(borg_list_process)
+
+    return newest
+
+
+#
+# Decode archives of a borg list --json document one at a time,
+# only one archive is held in memory
+#
+def json_archives(stream, blocksize=65536):
+    decoder = json.JSONDecoder()
+    data = ""
+    position = 0
+    in_archives = False
 
-                else:
-                    if args.verbose:
-                        print("not newest backup: " + backupname)
+    while True:
+        block = stream.read(blocksize)
+        if block:
+            data = data[position:] + block
+            position = 0
+        elif not data[position:].strip():
+            return
 
+        if not in_archives:
+            match_archives = re_json_archives.search(data)
+            if not match_archives:
+                if not block:
+                    return
+                continue
+            position = match_archives.end()
+            in_archives = True
+
+        while True:
+            while position < len(data) and data[position] in " \t\r\n,":
+                position += 1
+            if position < len(data) and data[position] == "]":
+                return
+            try:
+                archive, position = decoder.raw_decode(data, position)
+            except ValueError:
+                if not block:
+                    return
+                break
+            yield archive
+
+
+#
+# Search newest archive of each pattern with borg list --json,
+# prefix, glob and last filters are applied by borg
+#
+def borg_list_json(repository, options):
+    patterns = archive_patterns(options)
+    newest = {}
+
+    command = ["borg", "list", "--json", "--lock-wait", str(options.lockwait)]
+    if options.prefix:
+        command += ["--prefix", options.prefix]
+    if options.glob:
+        command += ["--glob-archives", options.glob]
+    if options.last:
+        command += ["--last", str(options.last)]
+    command.append(repository)
+
+    first_output = True
+    list_start = time.perf_counter()
+    borg_list_process = borg_popen(command, options, "borg list")
+
+    for archive in json_archives(
+            io.TextIOWrapper(borg_list_process.stdout, encoding='utf-8')):
+        parse_start = time.perf_counter()
+
+        #
+        # lock and manifest load until first archive
+        #
+        if first_output:
+            phase_time(options, "lock", list_start)
+            list_start = parse_start
+            first_output = False
+
+        backupname = archive["name"]
+        backupdate = None
+
+        for pattern_name, re_include in patterns:
+            if not re_include.match(backupname):
                 if args.verbose:
-                    print("getting informations for backup " + backupname)
+                    print("backup excluded %s: %s" % (
+                        pattern_name, backupname))
+                continue
 
-    #
-    # waiting borg list process
-    #
-    borg_list_process.wait()
+            if backupdate is None:
+                backupdate = datetime.datetime.strptime(
+                    archive["time"][:19],
+                    '%Y-%m-%dT%H:%M:%S')
+            if pattern_name not in newest or \
+                    backupdate > newest[pattern_name][1]:
+                newest[pattern_name] = (backupname, backupdate,
+                                        archive.get("id"))
+            elif args.verbose:
+                print("not newest backup: " + backupname)
 
-    #
-    # search backup informations
-    #
-    borg_info_process = subprocess.Popen(
+        phase_time(options, "parse", parse_start)
+
+    phase_time(options, "list", list_start)
+    borg_wait(borg_list_process)
+
+    return newest
+
+
+#
+# Archive and repository sizes with borg info
+#
+def borg_info(repository, backupname, options):
+    sizes = {}
+
+    if args.verbose:
+        print("getting informations for backup " + backupname)
+
+    info_start = time.perf_counter()
+    borg_info_process = borg_popen(
         [
             "borg",
             "info",
-            args.repository + "::" + lastbackupname
+            "--lock-wait",
+            str(options.lockwait),
+            repository + "::" + backupname
         ],
-        stdout = subprocess.PIPE
+        options,
+        "borg info"
     )
 
     for buffer_info in borg_info_process.stdout:
@@ -220,88 +567,606 @@ try:
         line_info = str(buffer_info, 'utf-8')
 
         #
-        # search backup by backupname or globaly
+        # search backup sizes and global repository sizes
         #
-        if args.globalsize:
-            match_info = re_global.match(line_info)
-        else:
-            match_info = re_archive.match(line_info)
+        for key, regex in (("archive", re_archive), ("global", re_global)):
+            match_info = regex.match(line_info)
+            if match_info:
+                if args.verbose:
+                    print(
+                        "%s %s: %s %s original, %s %s compressed, "
+                        "%s %s deduplicated" %
+                        (
+                            backupname,
+                            key,
+                            match_info.group(1),
+                            match_info.group(2),
+                            match_info.group(3),
+                            match_info.group(4),
+                            match_info.group(5),
+                            match_info.group(6)
+                        )
+                    )
+                sizes[key] = [
+                    bytes_fmt(match_info.group(1), match_info.group(2)),
+                    bytes_fmt(match_info.group(3), match_info.group(4)),
+                    bytes_fmt(match_info.group(5), match_info.group(6))
+                ]
 
-        if match_info:
+    phase_time(options, "info", info_start)
+    borg_wait(borg_info_process)
 
-            if args.verbose:
-                print(
-                    "%s: %s %s original, %s %s compressed, %s %s deduplicated" %
-                    (
-                        backupname,
-                        match_info.group(1),
-                        match_info.group(2),
-                        match_info.group(3),
-                        match_info.group(4),
-                        match_info.group(5),
-                        match_info.group(6)
-                    )
-                )
-            lastbackup_original_size = bytes_fmt(
-                match_info.group(1),
-                match_info.group(2)
-            )
-            lastbackup_compressed_size = bytes_fmt(
-                match_info.group(3),
-                match_info.group(4)
-            )
-            lastbackup_deduplicated_size = bytes_fmt(
-                match_info.group(5),
-                match_info.group(6)
-            )
+    return sizes
 
-    borg_info_process.wait()
 
+#
+# State results depend on every archive selection option
+#
+def result_key(options):
+    return "|".join(
+        str(option) for option in
+        (options.include, options.json, options.prefix, options.glob,
+         options.last, options.pattern, options.globalsize))
+
+
+#
+# Status of the newest archive of a pattern,
+# returns (return code, status line, perfdatas)
+#
+def backup_status(backup, options):
+    limitbackupagec = datetime.timedelta(hours=options.delayc)
+    limitbackupagew = datetime.timedelta(hours=options.delayw)
+
+    try:
+        lastbackupname = backup["name"]
+        lastbackupdate = datetime.datetime.strptime(
+            backup["date"],
+            '%Y-%m-%d %H:%M:%S')
+
+        #
+        # search backup sizes by backupname or globaly
+        #
+        if options.globalsize:
+            lastbackup_original_size, \
+                lastbackup_compressed_size, \
+                lastbackup_deduplicated_size = backup["sizes"]["global"]
+        else:
+            lastbackup_original_size, \
+                lastbackup_compressed_size, \
+                lastbackup_deduplicated_size = backup["sizes"]["archive"]
+
+    except (TypeError, KeyError):
+        return 2, "ERROR: no matching backup found", ""
 
+    lastbackupage = datetime.datetime.now() - lastbackupdate
 
-    
     if lastbackupage > limitbackupagec:
         if args.verbose:
             print("ERROR: last backup out of date")
-        print("ERROR ", end='')
+        status_line = "ERROR "
         cr = 2
     elif lastbackupage > limitbackupagew:
         if args.verbose:
             print("WARNING: last backup out of date")
-        print("WARNING ", end='')
+        status_line = "WARNING "
         cr = 1
     else:
         if args.verbose:
             print("last backup OK")
-        print("OK ", end='')
+        status_line = "OK "
         cr = 0
 
-    print("%s last backup date: %s, age: %s, osize: %s csize: %s dsize: %s | osize=%d csize=%d dsize=%d" %
-          (
-              lastbackupname,
-              lastbackupdate.isoformat(),
-              iso8601(lastbackupage),
-              sizeof_fmt(lastbackup_original_size),
-              sizeof_fmt(lastbackup_compressed_size),
-              sizeof_fmt(lastbackup_deduplicated_size),
-              lastbackup_original_size,
-              lastbackup_compressed_size,
-              lastbackup_deduplicated_size
-          ),
-          end=''
-          )
-
-    if args.status:
-        print(" status=%d" % cr)
+    status_line += "%s last backup date: %s, age: %s, osize: %s csize: %s dsize: %s" % (
+        lastbackupname,
+        lastbackupdate.isoformat(),
+        iso8601(lastbackupage),
+        sizeof_fmt(lastbackup_original_size),
+        sizeof_fmt(lastbackup_compressed_size),
+        sizeof_fmt(lastbackup_deduplicated_size)
+    )
+    perfdatas = "osize=%d csize=%d dsize=%d" % (
+        lastbackup_original_size,
+        lastbackup_compressed_size,
+        lastbackup_deduplicated_size
+    )
+
+    return cr, status_line, perfdatas
+
+
+#
+# Archive or global repository sizes, borg info only runs for an
+# archive not yet in the state file, or for global sizes when the
+# repository transaction has moved
+#
+def archive_sizes(repository, backupname, archive_id, options, state,
+                  markers, info_function):
+    archives = state.setdefault("archives", {})
+    archive_key = archive_id or backupname
+
+    if options.globalsize:
+        cached_global = state.get("global")
+        if markers and cached_global and cached_global["markers"] == markers:
+            if args.verbose:
+                print("global sizes unchanged, using state file")
+            return {"global": cached_global["sizes"]}
+    elif archive_key in archives:
+        if args.verbose:
+            print("archive %s sizes from state file" % (backupname))
+        archives[archive_key] = archives.pop(archive_key)
+        return {"archive": archives[archive_key]}
+
+    sizes = info_function(repository, backupname, options)
+
+    if "archive" in sizes:
+        archives[archive_key] = sizes["archive"]
+        while len(archives) > archives_cache_size:
+            del archives[next(iter(archives))]
+    if "global" in sizes:
+        state["global"] = {"markers": markers, "sizes": sizes["global"]}
+
+    return sizes
+
+
+#
+# Borg python API session: the repository, manifest and cache are
+# opened once for listing and archive statistics,
+# yields (list function, info function) like borg_list and borg_info
+#
+@contextlib.contextmanager
+def borg_api_session(repository, options):
+    from borg.archive import Archive
+    from borg.cache import Cache
+    from borg.helpers import Error, Location, Manifest
+    from borg.locking import LockError
+    from borg.repository import Repository
+
+    location = Location(repository)
+    if location.proto != 'file':
+        raise ImportError("borg API backend only opens local repositories")
+
+    lock_start = time.perf_counter()
+    try:
+        with Repository(location.path,
+                        exclusive=False,
+                        lock_wait=options.lockwait) as borg_repository, \
+                contextlib.ExitStack() as stack:
+            manifest, key = Manifest.load(borg_repository,
+                                          (Manifest.Operation.READ,))
+            phase_time(options, "lock", lock_start)
+            caches = []
+
+            def api_list(repository, options):
+                list_start = time.perf_counter()
+                patterns = archive_patterns(options)
+                newest = {}
+                for archive_info in manifest.archives.list(
+                        glob=options.glob or (
+                            options.prefix + "*" if options.prefix else None),
+                        sort_by=['ts'],
+                        last=options.last):
+
+                    #
+                    # archive time in local time, like borg list
+                    #
+                    backupdate = archive_info.ts
+                    if backupdate.tzinfo is None:
+                        backupdate = backupdate.replace(
+                            tzinfo=datetime.timezone.utc)
+                    backupdate = datetime.datetime.fromtimestamp(
+                        int(backupdate.timestamp()))
+
+                    for pattern_name, re_include in patterns:
+                        if not re_include.match(archive_info.name):
+                            if args.verbose:
+                                print("backup excluded %s: %s" % (
+                                    pattern_name, archive_info.name))
+                            continue
+                        if pattern_name not in newest or \
+                                backupdate > newest[pattern_name][1]:
+                            newest[pattern_name] = (archive_info.name,
+                                                    backupdate,
+                                                    archive_info.id.hex())
+                phase_time(options, "list", list_start)
+                return newest
+
+            def api_info(repository, backupname, options):
+                info_start = time.perf_counter()
+                if args.verbose:
+                    print("getting informations for backup " + backupname)
+
+                #
+                # chunks cache is opened only when sizes are needed
+                #
+                if not caches:
+                    caches.append(stack.enter_context(
+                        Cache(borg_repository, key, manifest,
+                              lock_wait=options.lockwait)))
+                archive = Archive(borg_repository, key, manifest, backupname,
+                                  cache=caches[0])
+                stats = archive.calc_stats(caches[0])
+                summary = caches[0].chunks.summarize()
+                phase_time(options, "info", info_start)
+                return {
+                    "archive": [stats.osize, stats.csize, stats.usize],
+                    "global": [summary[0], summary[1], summary[3]]
+                }
+
+            yield api_list, api_info
+
+    except LockError as error:
+        raise RepositoryLocked(str(error))
+    except Error as error:
+        raise BorgError(str(error))
+
+
+#
+# Newest archive of each pattern with borg list and borg info,
+# saved in the state file,
+# returns {pattern name: {"name", "date", "sizes"}}
+#
+def fetch_backups(repository, options, state, markers):
+    if options.backend == "api":
+        try:
+            with borg_api_session(repository, options) as session:
+                return store_backups(repository, options, state, markers,
+                                     *session)
+        except ImportError as error:
+            if args.verbose:
+                print("borg API backend not available (%s), "
+                      "using borg commands" % (error))
+
+    return store_backups(repository, options, state, markers,
+                         borg_list, borg_info)
+
+
+#
+# Newest archive of each pattern and its sizes saved in the state file
+#
+def store_backups(repository, options, state, markers,
+                  list_function, info_function):
+
+    #
+    # one borg list for every pattern, one borg info per
+    # distinct newest archive
+    #
+    newest = list_function(repository, options)
+    backups = {}
+    infos = {}
+    for pattern_name, backup in newest.items():
+        lastbackupname, lastbackupdate, archive_id = backup
+        if lastbackupname not in infos:
+            infos[lastbackupname] = archive_sizes(repository,
+                                                  lastbackupname,
+                                                  archive_id,
+                                                  options,
+                                                  state,
+                                                  markers,
+                                                  info_function)
+        backups[pattern_name] = {
+            "name": lastbackupname,
+            "date": lastbackupdate.strftime('%Y-%m-%d %H:%M:%S'),
+            "sizes": infos[lastbackupname]
+        }
+
+    if options.cachedir:
+
+        #
+        # archive and global sizes are kept across transactions
+        #
+        if state.get("markers") != markers or "checked" not in state:
+            state.update({"markers": markers, "results": {}, "checked": {}})
+        state["results"][result_key(options)] = backups
+        state["checked"][result_key(options)] = time.time()
+        save_state(state_path(options.cachedir, repository), state)
+
+    return backups
+
+
+#
+# Refresh the state file in a detached process once the lock is released
+#
+def start_refresh(repository, options):
+    refresh = dict(vars(options))
+    refresh["repository"] = repository
+    subprocess.Popen(
+        [
+            sys.executable,
+            os.path.abspath(__file__),
+            "--refresh",
+            json.dumps(refresh)
+        ],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True)
+
+
+#
+# Background refresh: wait for the repository lock, then run borg,
+# only one refresh per repository at a time
+#
+def refresh_repository(options):
+    statefile = state_path(options.cachedir, options.repository)
+    os.makedirs(options.cachedir, exist_ok=True)
+    with open(statefile + ".refresh", "w") as fd_refresh:
+        try:
+            fcntl.flock(fd_refresh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return
+
+        deadline = time.time() + options.refreshwait
+        while repository_locked(options.repository) and \
+                time.time() < deadline:
+            time.sleep(max(0, min(10, deadline - time.time())))
+
+        options.lockwait = max(1, int(deadline - time.time()))
+        options.deadline = None
+        options.phases = {}
+        fetch_backups(options.repository,
+                      options,
+                      load_state(statefile),
+                      repository_markers(options.repository))
+
+
+#
+# Phase timings perfdatas (--timings)
+#
+def timings_perfdata(options):
+    if not args.timings:
+        return ""
+    return " ".join(
+        "%s_ms=%d" % (phase, options.phases.get(phase, 0) * 1000)
+        for phase in ("lock", "list", "info", "parse"))
+
+
+#
+# Check last backup of each pattern in one repository,
+# returns (return code, status line, perfdatas)
+#
+def check_repository(repository, options):
+    patterns = archive_patterns(options)
+    stale = None
+    options.phases = {}
+
+    try:
+
+        #
+        # load previous result when the repository has not moved
+        # (markers are read before borg runs, so a concurrent change
+        # is detected on the next check)
+        #
+        state = {}
+        markers = None
+        backups = None
+        if options.cachedir:
+            statefile = state_path(options.cachedir, repository)
+            state = load_state(statefile)
+            markers = repository_markers(repository)
+            if markers and state.get("markers") == markers:
+                backups = state.get("results", {}).get(result_key(options))
+
+        if backups is not None:
+            if args.verbose:
+                print("repository unchanged, using state file " + statefile)
+
+        else:
+
+            #
+            # locked repository: last result, refreshed in background
+            #
+            lock_start = time.perf_counter()
+            if lock_window():
+                stale = "borg lock time window"
+            elif repository_locked(repository):
+                stale = "repository locked"
+            phase_time(options, "lock", lock_start)
+
+            if not stale:
+                try:
+                    backups = fetch_backups(repository, options,
+                                            state, markers)
+                except RepositoryLocked:
+                    stale = "repository locked"
+
+            if stale:
+                if args.verbose:
+                    print(stale + ", using last result")
+                if stale == "repository locked" and options.cachedir:
+                    start_refresh(repository, options)
+                backups = state.get("results", {}).get(result_key(options))
+                if backups is None:
+                    if lock_window():
+                        return 0, "OK borg lock time window, check skipped", ""
+                    return 3, "UNKNOWN: %s, no cached result" % stale, ""
+
+    except FileNotFoundError as eh:
+        return 2, "%s %s" % (eh.strerror, eh.filename), ""
+
+    except BorgError as error:
+        return 2, "ERROR: borg %s" % error, ""
+
+    except DeadlineExceeded as error:
+        return 3, "UNKNOWN: %s exceeded deadline of %d seconds" % (
+            error.args[0], options.deadline), timings_perfdata(options)
+
+    results = [
+        (pattern_name,) + backup_status(backups.get(pattern_name), options)
+        for pattern_name, re_include in patterns
+    ]
+
+    if len(results) == 1:
+        cr, status_line, perfdatas = results[0][1:]
+
+    else:
+        cr = max(result[1] for result in results)
+        status_line = status_names[cr] + " " + ", ".join(
+            "%s: %s" % (pattern_name, status_line)
+            for pattern_name, pattern_cr, status_line, perfdatas in results)
+        perfdatas = " ".join(
+            "%s_%s" % (pattern_name, perfdata)
+            for pattern_name, pattern_cr, status_line, perfdatas in results
+            for perfdata in perfdatas.split())
+
+    if stale:
+        checked = state.get("checked", {}).get(result_key(options))
+        status_line += " (stale: %s, cached result age: %s)" % (
+            stale,
+            iso8601(datetime.timedelta(seconds=time.time() - checked))
+            if checked else "unknown")
+
+    if args.timings:
+        perfdatas = (perfdatas + " " + timings_perfdata(options)).strip()
+
+    return cr, status_line, perfdatas
+
+
+#
+# Command line options overridden by a repository configuration section
+#
+def section_options(config, section):
+    options = argparse.Namespace(**vars(args))
+    for name in ("include", "prefix", "glob", "cachedir"):
+        if config.has_option(section, name):
+            setattr(options, name, config.get(section, name))
+    for name in ("delayw", "delayc", "last"):
+        if config.has_option(section, name):
+            setattr(options, name, config.getint(section, name))
+    for name in ("json", "globalsize"):
+        if config.has_option(section, name):
+            setattr(options, name, config.getboolean(section, name))
+    if config.has_option(section, "patterns"):
+        options.pattern = [
+            pattern.strip()
+            for pattern in config.get(section, "patterns").split(",")
+        ]
+        for pattern in options.pattern:
+            if "=" not in pattern:
+                raise ValueError("pattern %s is not NAME=REGEX" % pattern)
+    return options
+
+
+#
+# Check one configured repository, a configuration or borg failure
+# is reported as UNKNOWN for this repository only,
+# returns (return code, status line, perfdatas)
+#
+def check_section(config, section):
+    try:
+        return check_repository(config.get(section, "repository"),
+                                section_options(config, section))
+    except Exception as error:
+        return 3, "UNKNOWN: %s" % error, ""
+
+
+#
+# Check every configured repository with a bounded worker pool,
+# returns [(section, return code, status line, perfdatas)]
+#
+def check_repositories(config):
+    sections = [
+        section.strip()
+        for section in config.get("general", "repositories").split(",")
+        if section.strip()
+    ]
+    workers = args.workers or config.getint("general", "workers", fallback=4)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers) as executor:
+        futures = [
+            (
+                section,
+                executor.submit(check_section, config, section)
+            )
+            for section in sections
+        ]
+        return [(section,) + future.result() for section, future in futures]
+
+
+#
+# Submit one passive service check result per repository
+#
+def submit_passive(config, results):
+    with open(args.passive, "a") as fd_command:
+        for section, cr, status_line, perfdatas in results:
+            fd_command.write(
+                "[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n" % (
+                    time.time(),
+                    config.get(section, "host"),
+                    config.get(section, "service", fallback="borg_" + section),
+                    cr,
+                    status_line + ("|" + perfdatas if perfdatas else "")
+                ))
+
+
+status_names = {0: "OK", 1: "WARNING", 2: "ERROR", 3: "UNKNOWN"}
+archives_cache_size = 256
+re_date = re.compile("(\S*)\s*.*, (....-..-.. ..:..:..)$")
+re_archive = re.compile("^This archive:\s*(\S*)\s(..)\s*(\S*)\s(..)\s*(\S*)\s(..)$")
+re_global = re.compile("^All archives:\s*(\S*)\s(..)\s*(\S*)\s(..)\s*(\S*)\s(..)$")
+re_transaction = re.compile("^(index|hints)\.(\d+)$")
+re_json_archives = re.compile('"archives"\s*:\s*\[')
+re_lock_error = re.compile("acquire the lock")
+
+cr = 2
+
+try:
+
+    #
+    # Setting HOME environment variable for sudo calls
+    #
+    if args.home:
+        os.environ['HOME'] = args.home
+
+    if args.refresh:
+        refresh_repository(argparse.Namespace(**json.loads(args.refresh)))
+        exit(0)
+
+    if args.config:
+        config = configparser.ConfigParser(interpolation=None)
+        config.read_file(open(args.config))
+        results = check_repositories(config)
+
+        if args.passive:
+            submit_passive(config, results)
+
+        cr = max(result[1] for result in results)
+        print("%s %s|%s" % (
+            status_names[cr],
+            " ".join("%s:%s" % (section, status_names[section_cr])
+                     for section, section_cr, status_line, perfdatas
+                     in results),
+            " ".join("%s_%s" % (section, perfdata)
+                     for section, section_cr, status_line, perfdatas
+                     in results
+                     for perfdata in perfdatas.split())
+        ), end='')
+
+        if args.status:
+            print(" status=%d" % cr)
+        else:
+            print("")
+
+        for section, section_cr, status_line, perfdatas in results:
+            print("%s: %s" % (section, status_line))
+
     else:
-        print("")
+        cr, status_line, perfdatas = check_repository(args.repository, args)
+
+        if perfdatas:
+            print("%s | %s" % (status_line, perfdatas), end='')
+            if args.status:
+                print(" status=%d" % cr)
+            else:
+                print("")
+        else:
+            print(status_line)
 
-except NameError:
-    print("ERROR: no matching backup found")
+except FileNotFoundError as error:
+    print("error opening file", error.filename, error.strerror)
     cr = 2
 
-except FileNotFoundError as eh:
-    print(eh.strerror, eh.filename)
+except configparser.Error as error:
+    print("error configuration file %s" % (args.config), error.message)
     cr = 2
 
 exit(cr)
@@ -7,10 +7,15 @@
 # Copyright (C) 2016-2018, Christophe Fauchard
 # -----------------------------------------------------------------
 
-__version_info__ = (0, 3, 1, 'b0')
+__version_info__ = (0, 7, 0, 'b0')
 __version__ = '.'.join(map(str, __version_info__))
 
+import os
 import re
+import glob
+import gzip
+import json
+import math
 import datetime
 import argparse
 import sys
@@ -41,6 +46,380 @@ def bytes_fmt(text_value, unit):
         return(value * 1024**3)
     elif unit == "TB":
         return(value * 1024**4)
+    elif unit == "B":
+        return(value)
+
+
+#
+# Read lines of a file from its end, block by block,
+# yields (line offset, line)
+#
+def reverse_lines(fd, blocksize=65536):
+    fd.seek(0, os.SEEK_END)
+    position = fd.tell()
+    remainder = b""
+    while position > 0:
+        size = min(blocksize, position)
+        position -= size
+        fd.seek(position)
+        lines = (fd.read(size) + remainder).split(b"\n")
+        remainder = lines.pop(0)
+        end = position + len(remainder)
+        for line in lines:
+            end += len(line) + 1
+        for line in reversed(lines):
+            end -= len(line)
+            yield end, line
+            end -= 1
+    yield 0, remainder
+
+
+#
+# Last complete run of the log, from "Archive name" to "All archives"
+# (or a borg create --json document),
+# returns (run, offset after the run)
+#
+def last_run(fd, max_lines=100):
+    lines = []
+    for offset, buffer in reverse_lines(fd):
+        if not lines:
+            match_field = re_field.search(buffer)
+            if buffer.rstrip() == b"}" or \
+                    (match_field and match_field.group(1) == b"All archives"):
+                lines.append(buffer)
+                end = offset + len(buffer) + 1
+        else:
+            lines.append(buffer)
+            if lines[0].rstrip() == b"}":
+                run_start = buffer.rstrip() == b"{"
+            else:
+                match_field = re_field.search(buffer)
+                run_start = match_field and \
+                    match_field.group(1) == b"Archive name"
+
+            if run_start:
+                run = {}
+                for line in reversed(lines):
+                    parse_line(line, run)
+                if "name" in run and "global" in run:
+                    return run, end
+                lines = []
+
+            #
+            # no run start before the sizes: incomplete run
+            #
+            if len(lines) > max_lines:
+                lines = []
+    return {}, 0
+
+
+#
+# Fill run fields from a borg create --json document
+#
+def parse_json(document, run):
+    archive = document.get("archive", {})
+    archive_stats = archive.get("stats")
+    cache_stats = document.get("cache", {}).get("stats")
+    if not archive_stats or not cache_stats:
+        return
+
+    run.clear()
+    run["name"] = archive["name"]
+    run["start"] = archive["start"].replace("T", " ")[:19]
+    run["end"] = archive["end"].replace("T", " ")[:19]
+    run["archive"] = [
+        str(archive_stats["original_size"]), "B",
+        str(archive_stats["compressed_size"]), "B",
+        str(archive_stats["deduplicated_size"]), "B"
+    ]
+    run["global"] = [
+        str(cache_stats["total_size"]), "B",
+        str(cache_stats["total_csize"]), "B",
+        str(cache_stats["unique_csize"]), "B"
+    ]
+
+
+#
+# Fill run fields from one log line (bytes), a run starts at
+# "Archive name". Each line is classified once by the field prefix;
+# borg --log-json lines and borg create --json documents are accepted
+#
+def parse_line(buffer, run):
+
+    #
+    # borg create --json document in progress
+    #
+    if "json" in run:
+        run["json"].append(buffer.decode('utf-8', 'replace'))
+        if buffer.rstrip() == b"}":
+            try:
+                parse_json(json.loads("\n".join(run.pop("json"))), run)
+            except (ValueError, KeyError, AttributeError):
+                pass
+        return
+
+    if buffer[:1] == b"{":
+        if buffer.rstrip() == b"{":
+            run["json"] = ["{"]
+            return
+        try:
+            record = json.loads(buffer.decode('utf-8', 'replace'))
+        except ValueError:
+            return
+        if not isinstance(record, dict):
+            return
+        if record.get("type") != "log_message":
+            try:
+                parse_json(record, run)
+            except (KeyError, AttributeError):
+                pass
+            return
+        buffer = record.get("message", "").encode('utf-8')
+
+    match_field = re_field.search(buffer)
+    if not match_field:
+        return
+
+    field = match_field.group(1)
+    value = match_field.group(2).decode('utf-8', 'replace').strip()
+
+    if field == b"Archive name":
+        run.clear()
+        run["name"] = value
+    elif field in (b"Time (start)", b"Time (end)"):
+        match_date = re_date.search(value)
+        if match_date:
+            run[fields[field]] = match_date.group(1)
+    else:
+        sizes = value.split()
+        if len(sizes) == 6:
+            run[fields[field]] = sizes
+
+
+#
+# Blocks of complete lines of a file from its current position,
+# each block ends with a newline
+#
+def complete_blocks(fd, blocksize=1048576):
+    remainder = b""
+    for block in iter(lambda: fd.read(blocksize), b""):
+        block = remainder + block
+        end = block.rfind(b"\n") + 1
+        remainder = block[end:]
+        if end:
+            yield block[:end]
+
+
+#
+# Lines of a block worth parsing: the field lines found by one scan
+# of the whole block, or every line when JSON may be involved
+#
+def field_lines(block, pending):
+    if "json" in pending or b"{" in block or b"}" in block:
+        return block.split(b"\n")[:-1]
+    return (block[block.rfind(b"\n", 0, match_field.start()) + 1:
+                  match_field.end()]
+            for match_field in re_field.finditer(block))
+
+
+#
+# Parse complete lines appended after offset,
+# returns (offset, pending run, last complete run)
+#
+def parse_forward(fd, offset, pending, last):
+    fd.seek(offset)
+    for block in complete_blocks(fd):
+        offset += len(block)
+        for buffer in field_lines(block, pending):
+            parse_line(buffer, pending)
+            if "name" in pending and "global" in pending:
+                last = dict(pending)
+                pending.clear()
+    return offset, pending, last
+
+
+#
+# Complete runs of a log file as compact records
+# (start, end, archive original size, archive deduplicated size,
+# repository deduplicated size), dates in epoch seconds
+#
+def run_records(fd):
+    pending = {}
+    for block in complete_blocks(fd):
+        for buffer in field_lines(block, pending):
+            parse_line(buffer, pending)
+            if "name" not in pending or "global" not in pending:
+                continue
+            if "start" in pending and "end" in pending and \
+                    "archive" in pending:
+                yield (
+                    datetime.datetime.strptime(
+                        pending["start"], '%Y-%m-%d %H:%M:%S').timestamp(),
+                    datetime.datetime.strptime(
+                        pending["end"], '%Y-%m-%d %H:%M:%S').timestamp(),
+                    bytes_fmt(pending["archive"][0], pending["archive"][1]),
+                    bytes_fmt(pending["archive"][4], pending["archive"][5]),
+                    bytes_fmt(pending["global"][4], pending["global"][5])
+                )
+            pending.clear()
+
+
+#
+# Nearest rank percentile of sorted values
+#
+def percentile(values, rank):
+    return values[max(0, math.ceil(rank / 100.0 * len(values)) - 1)]
+
+
+#
+# History mode: one streaming pass over every log (rotated logs
+# included, gzip or plain) keeping runs of the window only,
+# returns the plugin return code
+#
+def check_history():
+    cr = 0
+    window_start = (datetime.datetime.now() -
+                    datetime.timedelta(days=args.window)).timestamp()
+    runs = []
+
+    logfiles = sorted(glob.glob(args.borglogfile), key=os.path.getmtime)
+    for logfile in logfiles:
+        if args.verbose:
+            print("parsing log file %s" % (logfile))
+        if logfile.endswith(".gz"):
+            fd_log = gzip.open(logfile, "rb")
+        else:
+            fd_log = open(logfile, "rb")
+        with fd_log:
+            for record in run_records(fd_log):
+                if record[1] >= window_start:
+                    runs.append(record)
+    runs.sort()
+
+    if not runs:
+        print("CRITICAL: no borg run found in %s for the last %d days" % (
+            args.borglogfile, args.window))
+        return 2
+
+    start, end, osize, dsize, gdsize = runs[-1]
+    duration = end - start
+    end_date = datetime.datetime.fromtimestamp(end)
+    backupage = datetime.datetime.now() - end_date
+
+    #
+    # duration statistics of the previous runs
+    #
+    durations = sorted(run[1] - run[0] for run in runs[:-1])
+    if durations:
+        duration_mean = sum(durations) / len(durations)
+        duration_p95 = percentile(durations, 95)
+    else:
+        duration_mean = duration_p95 = duration
+
+    dedup_ratio = osize / dsize if dsize else 0
+    dedup_ratio_mean = sum(
+        run[2] / run[3] for run in runs if run[3]) / len(runs)
+    growth_days = (runs[-1][1] - runs[0][1]) / 86400.0
+    growth_per_day = (gdsize - runs[0][4]) / growth_days \
+        if growth_days else 0
+
+    if args.verbose:
+        print("runs: %d" % (len(runs)))
+        print("duration: %ds mean: %ds p95: %ds" % (
+            duration, duration_mean, duration_p95))
+        print("dedup ratio: %.2f mean: %.2f" % (dedup_ratio, dedup_ratio_mean))
+        print("repository growth per day: %s" % (sizeof_fmt(growth_per_day)))
+
+    #
+    # latest run duration outlier, ratio to the p95 of previous runs
+    #
+    if len(durations) >= args.minruns and duration_p95:
+        if duration > duration_p95 * args.durationc:
+            if args.verbose:
+                print("CRITICAL: duration outlier")
+            cr = 2
+        elif duration > duration_p95 * args.durationw:
+            if args.verbose:
+                print("WARNING: duration outlier")
+            cr = 1
+
+    if backupage > limitbackupagec:
+        if args.verbose:
+            print("CRITICAL: backup age too large: %s" % (backupage))
+        cr = 2
+    elif backupage > limitbackupagew:
+        if args.verbose:
+            print("WARNING: backup age too large: %s" % (backupage))
+        if cr < 1:
+            cr = 1
+
+    if cr == 2:
+        sys.stdout.write("CRITICAL: ")
+    elif cr == 1:
+        sys.stdout.write("WARNING: ")
+    else:
+        sys.stdout.write("OK: ")
+
+    sys.stdout.write(
+        "%s (%s), %d runs: duration mean %s p95 %s, "
+        "dedup ratio %.1f (mean %.1f), repository growth %s/day" % (
+            str(end_date),
+            str(datetime.timedelta(seconds=duration)),
+            len(runs),
+            str(datetime.timedelta(seconds=int(duration_mean))),
+            str(datetime.timedelta(seconds=int(duration_p95))),
+            dedup_ratio,
+            dedup_ratio_mean,
+            sizeof_fmt(growth_per_day)
+        ))
+
+    sys.stdout.write(
+        " | duration=%ds duration_mean=%ds duration_p95=%ds "
+        "dedup_ratio=%.2f growth_per_day=%dB runs=%d" % (
+            duration,
+            duration_mean,
+            duration_p95,
+            dedup_ratio,
+            growth_per_day,
+            len(runs)
+        ))
+
+    if args.status:
+        print(" status=%d" % (cr))
+    else:
+        print("")
+
+    return cr
+
+
+#
+# State file path for a log file
+#
+def state_path(cachedir, logfile):
+    return os.path.join(
+        cachedir,
+        re.sub("[^A-Za-z0-9_.-]", "_", logfile.strip("/")) + ".json")
+
+
+#
+# Load state file, empty state if missing or unreadable
+#
+def load_state(path):
+    try:
+        with open(path, "r") as fd_state:
+            return json.load(fd_state)
+    except (OSError, ValueError):
+        return {}
+
+
+#
+# Save state file atomically
+#
+def save_state(path, state):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as fd_state:
+        json.dump(state, fd_state)
+    os.replace(path + ".tmp", path)
 
 
 parser = argparse.ArgumentParser(
@@ -62,41 +441,98 @@ parser.add_argument("--status",
 parser.add_argument("--verbose",
                     action='store_true',
                     help="verbosity flag")
+parser.add_argument("--cachedir",
+                    type=str,
+                    help="state directory, only parse lines appended "
+                    "since the last check")
+parser.add_argument("--history",
+                    action='store_true',
+                    help="borglogfile is a glob of logs (rotated, gzip), "
+                    "report duration, dedup ratio and growth trends")
+parser.add_argument("--window",
+                    type=int,
+                    help="history window in days",
+                    default=30)
+parser.add_argument("--durationw",
+                    type=float,
+                    help="warning when the last duration exceeds the "
+                    "previous runs p95 times this ratio",
+                    default=1.5)
+parser.add_argument("--durationc",
+                    type=float,
+                    help="critical when the last duration exceeds the "
+                    "previous runs p95 times this ratio",
+                    default=3.0)
+parser.add_argument("--minruns",
+                    type=int,
+                    help="min number of previous runs for the duration "
+                    "outlier check",
+                    default=5)
 parser.add_argument('borglogfile',
                     help="Borg log file")
 args = parser.parse_args()
 
 #
-# define parse log regex
+# define parse log regex: one pattern for every field prefix
 #
-re_name = re.compile("Archive name: (.*)")
-re_start_date = re.compile(
-    "Time\s\(start\):\s*(\S*)\s*.*, (....-..-.. ..:..:..)")
-re_end_date = re.compile(
-    "Time\s\(end\):\s*(\S*)\s*.*, (....-..-.. ..:..:..)")
-re_archive = re.compile(
-    "This archive:\s*(\S*)\s(..)\s*(\S*)\s(..)\s*(\S*)\s(..)")
-re_global = re.compile(
-    "All archives:\s*(\S*)\s(..)\s*(\S*)\s(..)\s*(\S*)\s(..)"
-)
+re_field = re.compile(
+    b"(Archive name|Time \\(start\\)|Time \\(end\\)|This archive|All archives):"
+    b"(.*)")
+re_date = re.compile("(....-..-.. ..:..:..)")
+fields = {
+    b"Time (start)": "start",
+    b"Time (end)": "end",
+    b"This archive": "archive",
+    b"All archives": "global"
+}
 lastbackupdate = datetime.datetime.strptime('1970-01-01', '%Y-%m-%d')
 cr = 0
 
 limitbackupagec = datetime.timedelta(hours=args.delayc)
 limitbackupagew = datetime.timedelta(hours=args.delayw)
 
+if args.history:
+    exit(check_history())
+
 #
-# Openning and load borg log file
+# Openning borg log file, parse lines appended since the last check
+# (same inode, not truncated) or load its last complete run
 #
-fd_borg_log = open(args.borglogfile, "r")
-borg_log_data = fd_borg_log.read()
+fd_borg_log = open(args.borglogfile, "rb")
+stat_borg_log = os.fstat(fd_borg_log.fileno())
+state = {}
+if args.cachedir:
+    statefile = state_path(args.cachedir, args.borglogfile)
+    state = load_state(statefile)
+
+if state.get("inode") == [stat_borg_log.st_dev, stat_borg_log.st_ino] and \
+        state.get("offset", 0) <= stat_borg_log.st_size:
+    if args.verbose:
+        print("parsing from offset %d" % (state["offset"]))
+    offset = state["offset"]
+    pending = state["pending"]
+    run = state["run"]
+else:
+    if args.verbose and args.cachedir:
+        print("new or truncated log file, parsing last run")
+    run, offset = last_run(fd_borg_log)
+    pending = {}
+
+offset, pending, run = parse_forward(fd_borg_log, offset, pending, run)
+
+if args.cachedir:
+    save_state(statefile, {
+        "inode": [stat_borg_log.st_dev, stat_borg_log.st_ino],
+        "offset": offset,
+        "pending": pending,
+        "run": run
+    })
 
 #
-# search archive name
+# archive name
 #
-match_name = re_name.search(borg_log_data)
-if match_name:
-    name = match_name.group(1)
+if "name" in run:
+    name = run["name"]
     if args.verbose:
         print("Archive name: %s" % (name))
 else:
@@ -105,12 +541,11 @@ else:
     cr = 2
 
 #
-# search archive start date
+# archive start date
 #
-match_start_date = re_start_date.search(borg_log_data)
-if match_start_date:
+if "start" in run:
     start_date = datetime.datetime.strptime(
-        match_start_date.group(2),
+        run["start"],
         '%Y-%m-%d %H:%M:%S')
     if args.verbose:
         print("start date: %s" % (start_date))
@@ -120,12 +555,11 @@ else:
     cr = 2
 
 #
-# search archive end date
+# archive end date
 #
-match_end_date = re_end_date.search(borg_log_data)
-if match_end_date:
+if "end" in run:
     end_date = datetime.datetime.strptime(
-        match_end_date.group(2),
+        run["end"],
         '%Y-%m-%d %H:%M:%S')
     backupage = datetime.datetime.now() - end_date
 
@@ -140,23 +574,12 @@ else:
     cr = 2
 
 #
-# search archive sizes
+# archive sizes
 #
-match_archive = re_archive.search(borg_log_data)
-if match_archive:
-    archive_osize = bytes_fmt(
-        match_archive.group(1),
-        match_archive.group(2)
-    )
-    archive_csize = bytes_fmt(
-        match_archive.group(3),
-        match_archive.group(4)
-    )
-
-    archive_dsize = bytes_fmt(
-        match_archive.group(5),
-        match_archive.group(6)
-    )
+if "archive" in run:
+    archive_osize = bytes_fmt(run["archive"][0], run["archive"][1])
+    archive_csize = bytes_fmt(run["archive"][2], run["archive"][3])
+    archive_dsize = bytes_fmt(run["archive"][4], run["archive"][5])
     if args.verbose:
         print("archive original size: %s" % (sizeof_fmt(archive_osize)))
         print("archive compressed size: %s" % (sizeof_fmt(archive_csize)))
@@ -167,22 +590,12 @@ else:
     cr = 2
 
 #
-# search global repository sizes
-#
-match_global = re_global.search(borg_log_data)
-if match_global:
-    global_osize = bytes_fmt(
-        match_global.group(1),
-        match_global.group(2)
-    )
-    global_csize = bytes_fmt(
-        match_global.group(3),
-        match_global.group(4)
-    )
-    global_dsize = bytes_fmt(
-        match_global.group(5),
-        match_global.group(6)
-    )
+# global repository sizes
+#
+if "global" in run:
+    global_osize = bytes_fmt(run["global"][0], run["global"][1])
+    global_csize = bytes_fmt(run["global"][2], run["global"][3])
+    global_dsize = bytes_fmt(run["global"][4], run["global"][5])
     if args.verbose:
         print("global original size: %s" % (sizeof_fmt(global_osize)))
         print("global compressed size: %s" % (sizeof_fmt(global_csize)))
@@ -3,15 +3,18 @@
 # -----------------------------------------------------------------
 # check mediawiki export for Nagios
 # - perfdata for backup size
+# - pages added, changed and deleted by the last change of the export
 #
 # Copyright (C) 2016-2017, Christophe Fauchard
 # -----------------------------------------------------------------
 
-__version_info__ = (0, 1, 0, 'b1')
+__version_info__ = (0, 3, 0, 'b1')
 __version__ = '.'.join(map(str, __version_info__))
 
 import os
 import re
+import stat
+import sqlite3
 import datetime
 import argparse
 
@@ -34,6 +37,20 @@ parser.add_argument("--verbose",
 parser.add_argument("--status",
                     action='store_true',
                     help="status in perfdata flag")
+parser.add_argument("--cachedir",
+                    type=str,
+                    help="directory of the export manifest (page name, size, "
+                    "mtime), changes since the previous check as perfdata")
+parser.add_argument("--rescan",
+                    action='store_true',
+                    help="list the export even if the directory mtime is "
+                    "unchanged")
+parser.add_argument("--deletedw",
+                    type=int,
+                    help="warning when this many pages were deleted")
+parser.add_argument("--deletedc",
+                    type=int,
+                    help="critical when this many pages were deleted")
 parser.add_argument('directory',
                     help="SQLite export directory")
 args = parser.parse_args()
@@ -83,58 +100,168 @@ def sizeof_fmt(num, suffix='B'):
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
 
-limitbackupagec = datetime.timedelta(hours=args.delayc)
-limitbackupagew = datetime.timedelta(hours=args.delayw)
-page_number = 0
-export_size = 0
+def scan_export(directory, pages=None):
+    # one scandir pass: suffix test first, then one stat per page file,
+    # returns (pages, size, newest page ctime in integer nanoseconds),
+    # fills pages with name: (size, mtime_ns) when given
+    page_number = 0
+    export_size = 0
+    lastbackupdate_ns = 0
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".wikitext"):
+                continue
+
+            try:
+                filestat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if not stat.S_ISREG(filestat.st_mode):
+                continue
+
+            if filestat.st_size == 0:
+                if args.verbose:
+                    print("Empty file: ", entry.path)
+                continue
+
+            page_number += 1
+            export_size += filestat.st_size
+            if filestat.st_ctime_ns > lastbackupdate_ns:
+                lastbackupdate_ns = filestat.st_ctime_ns
+            if pages is not None:
+                pages[entry.name] = (filestat.st_size, filestat.st_mtime_ns)
+
+            if args.verbose:
+                print("Wikitext page file detected: ", entry.name)
+                print("backup ok (size %s, date %s)" % (
+                    sizeof_fmt(filestat.st_size),
+                    datetime.datetime.fromtimestamp(
+                        filestat.st_ctime_ns / 1e9)))
+    return page_number, export_size, lastbackupdate_ns
+
+
+def open_manifest(cachedir, directory):
+    # export manifest: pages (name, size, mtime_ns) and export totals
+    # with the directory mtime and inode of the last listing
+    os.makedirs(cachedir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(
+        cachedir,
+        re.sub("[^A-Za-z0-9_.-]", "_", directory.strip("/")) + ".sqlite"))
+    conn.execute("create table if not exists pages (name text primary key, "
+                 "size integer, mtime_ns integer) without rowid;")
+    conn.execute("create table if not exists export (key text primary key, "
+                 "value integer);")
+    return conn
+
+
+def update_manifest(conn, directory, directory_stat, export, unchanged):
+    # list the export, store the differences with the manifest,
+    # returns (pages, size, newest ctime ns, added, changed, deleted),
+    # the counts of the last change are kept while the export is unchanged
+    pages = {}
+    page_number, export_size, lastbackupdate_ns = scan_export(
+        directory, pages)
+    previous = dict(
+        (name, (size, mtime_ns))
+        for name, size, mtime_ns in conn.execute(
+            "select name, size, mtime_ns from pages;"))
+
+    added = [name for name in pages if name not in previous]
+    changed = [name for name, page in pages.items()
+               if name in previous and previous[name] != page]
+    deleted = [name for name in previous if name not in pages]
+    if args.verbose:
+        for name in deleted:
+            print("Deleted page: ", name)
 
-re_wikitext = re.compile(".*\.wikitext$")
+    counts = (len(added), len(changed), len(deleted))
+    if unchanged and not any(counts):
+        counts = (export.get("added", 0), export.get("changed", 0),
+                  export.get("deleted", 0))
 
-lastbackupdate = datetime.datetime.strptime('1970-01-01', '%Y-%m-%d')
+    with conn:
+        conn.executemany("delete from pages where name = ?;",
+                         ((name,) for name in deleted))
+        conn.executemany("insert or replace into pages values (?, ?, ?);",
+                         ((name,) + pages[name] for name in added + changed))
+        conn.executemany("insert or replace into export values (?, ?);", (
+            ("directory_mtime_ns", directory_stat.st_mtime_ns),
+            ("directory_ino", directory_stat.st_ino),
+            ("pages", page_number),
+            ("size", export_size),
+            ("lastbackupdate_ns", lastbackupdate_ns),
+            ("added", counts[0]),
+            ("changed", counts[1]),
+            ("deleted", counts[2])
+        ))
+    return (page_number, export_size, lastbackupdate_ns) + counts
+
+
+limitbackupagec = datetime.timedelta(hours=args.delayc)
+limitbackupagew = datetime.timedelta(hours=args.delayw)
 
 try:
 
-    for filename in os.listdir(args.directory):
-        filepath = os.path.join(args.directory, filename)
-        if os.path.isfile(filepath):
+    if args.cachedir:
+        # directory stat before the listing: a change during the listing
+        # changes the directory mtime again, the next check lists it
+        directory_stat = os.stat(args.directory)
+        conn = open_manifest(args.cachedir, args.directory)
+        # pages added, changed and deleted by the last change of the
+        # export, reported until the export directory changes again
+        export = dict(conn.execute("select key, value from export;"))
+        unchanged = \
+            export.get("directory_mtime_ns") == directory_stat.st_mtime_ns \
+            and export.get("directory_ino") == directory_stat.st_ino
 
-            filesize = os.path.getsize(filepath)
-            filedate = datetime.datetime.fromtimestamp(
-                os.path.getctime(filepath))
+        # pages rewritten in place leave the directory mtime unchanged:
+        # the listing is only skipped while the last export is younger
+        # than the warning delay, older exports are listed at every check
+        fresh = datetime.datetime.now() - datetime.datetime.fromtimestamp(
+            export.get("lastbackupdate_ns", 0) / 1e9) <= limitbackupagew
+        if unchanged and fresh and not args.rescan:
+            if args.verbose:
+                print("export directory unchanged, listing skipped")
+            page_number = export["pages"]
+            export_size = export["size"]
+            lastbackupdate_ns = export["lastbackupdate_ns"]
+            added = export.get("added", 0)
+            changed = export.get("changed", 0)
+            deleted = export.get("deleted", 0)
+        else:
+            (page_number, export_size, lastbackupdate_ns,
+             added, changed, deleted) = update_manifest(
+                conn, args.directory, directory_stat, export, unchanged)
+        conn.close()
+    else:
+        page_number, export_size, lastbackupdate_ns = scan_export(
+            args.directory)
+
+    if page_number:
+        lastbackupdate = datetime.datetime.fromtimestamp(
+            lastbackupdate_ns / 1e9)
+        lastbackupage = datetime.datetime.now() - lastbackupdate
 
-            if filesize == 0:
-                if args.verbose:
-                    print("Empty file: ", filepath)
-            else:
-                if re_wikitext.match(filename):
-                    if args.verbose:
-                        print("Wikitext page file detected: ", filename)
-
-                    page_number += 1
-                    export_size += filesize
-                    backupdate = filedate
-                    backupage = datetime.datetime.now() - backupdate
-
-                    if backupdate > lastbackupdate:
-                        lastbackupdate = backupdate
-                        lastbackupsize = filesize
-                        lastbackupage = backupage
-
-                    if args.verbose:
-                        print("backupdate: ", backupdate.isoformat())
-                        print("backup SQLite ok (size %s, date %s)" %
-                              (sizeof_fmt(filesize), backupdate))
-                   
     if lastbackupage > limitbackupagec:
         if args.verbose:
             print("ERROR: last backup out of date")
         print("ERROR ", end='')
         cr = 2
+    elif args.cachedir and args.deletedc and deleted >= args.deletedc:
+        if args.verbose:
+            print("ERROR: %d pages deleted" % deleted)
+        print("ERROR ", end='')
+        cr = 2
     elif lastbackupage > limitbackupagew:
         if args.verbose:
             print("WARNING: last backup out of date")
         print("WARNING ", end='')
         cr = 1
+    elif args.cachedir and args.deletedw and deleted >= args.deletedw:
+        if args.verbose:
+            print("WARNING: %d pages deleted" % deleted)
+        print("WARNING ", end='')
+        cr = 1
     else:
         if args.verbose:
             print("last backup OK")
@@ -154,6 +281,10 @@ try:
           end=''
           )
 
+    if args.cachedir:
+        print(" added=%d changed=%d deleted=%d" % (added, changed, deleted),
+              end='')
+
     if args.status:
         print(" status=%d" % cr)
     else:
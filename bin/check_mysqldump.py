@@ -2,22 +2,35 @@
 # coding: utf8
 # -----------------------------------------------------------------
 # check mysqldump backups for Nagios
-# - gziped or plain SQL text format
+# - plain SQL text format, gzip, bzip2, xz or zstd compressed
 # - perfdata for backup size
 #
 # Copyright (C) 2016-2017, Christophe Fauchard
 # -----------------------------------------------------------------
 
-__version_info__ = (0, 4, 2, 'b1')
+__version_info__ = (0, 10, 0, 'b1')
 __version__ = '.'.join(map(str, __version_info__))
 
 import os
 import sys
 import re
+import bz2
 import gzip
+import lzma
+import json
+import stat
 import datetime
 import argparse
+import configparser
+import shutil
 import subprocess
+import multiprocessing
+import concurrent.futures
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 parser = argparse.ArgumentParser(description='check MySQL backups for Nagios with perfdatas for backup size')
 parser.add_argument("--version", action='version', version='%(prog)s ' + __version__)
@@ -25,12 +38,21 @@ parser.add_argument("--delayc", type=int, help="define delay hours for critical"
 parser.add_argument("--delayw", type=int, help="define delay hours for warning", default=24)
 parser.add_argument("--verbose", action='store_true', help="verbosity flag")
 parser.add_argument("--status", action='store_true', help="status in perfdata flag")
-parser.add_argument("--zcat", action='store_true', help="use zcat instead of gzip module (faster but less compatible)")
+parser.add_argument("--external", action='store_true', help="decompress with external commands (pigz, lbzip2, xz, zstd) instead of python modules (faster but less compatible)")
+parser.add_argument("--zcat", action='store_true', dest='external', help=argparse.SUPPRESS)
 parser.add_argument("--include", type=str, help="include regex", default="\.*")
+parser.add_argument("--cachedir", type=str, help="cache directory, only new or modified dumps are read")
+parser.add_argument("--all", action='store_true', help="verify every dump of the retention, not only the newest")
+parser.add_argument("--deep", action='store_true', help="read the whole dump: statements and rows per table, truncated statements")
+parser.add_argument("--workers", type=int, help="processes reading dumps with --all (default: number of cpus)", default=os.cpu_count())
 parser.add_argument('directory', help="mysqldump backup directory")
-parser.add_argument('database', help="MySQL database name")
+parser.add_argument("--config", type=str, help="configuration file, one section per database with its thresholds")
+parser.add_argument('database', nargs='*', help="MySQL database names")
 args = parser.parse_args()
 
+if not args.database and not args.config:
+    parser.error("database or --config required")
+
 def iso8601(value):
     # split seconds to larger units
     seconds = value.total_seconds()
@@ -73,128 +95,390 @@ def sizeof_fmt(num, suffix='B'):
         num /= 1024.0
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
-limitbackupagec = datetime.timedelta(hours=args.delayc)
-limitbackupagew = datetime.timedelta(hours=args.delayw)
+# last line of a buffer, without its end of line
+def last_line(buffer):
+    if buffer.endswith(b"\n"):
+        buffer = buffer[:-1]
+    return buffer.rsplit(b"\n", 1)[-1]
 
-re_gzip = re.compile(".*\.gz$")
-re_sql = re.compile(".*\.sql$")
-re_dump = re.compile("^-- Dump completed on (.*)$")
-re_include = re.compile(args.include)
-re_database = re.compile(args.database)
+# last line of a seekable plain file, reading blocks backwards from the end
+def tail_file(fh, blocksize=65536):
+    fh.seek(0, 2)
+    position = fh.tell()
+    tail = b""
+    while position > 0:
+        size = min(blocksize, position)
+        position -= size
+        fh.seek(position)
+        tail = fh.read(size) + tail
+        # stop as soon as the last line is complete
+        if tail.find(b"\n", 0, len(tail) - 1) >= 0:
+            break
+    return last_line(tail)
 
-lastbackupdate = datetime.datetime.strptime('1970-01-01', '%Y-%m-%d')
+# last line of a compressed stream, decompressed forward once keeping
+# only a rolling tail window (seeking backwards in a compressed stream
+# restarts decompression from its beginning)
+def tail_stream(fh, blocksize=1048576, window=65536):
+    tail = b""
+    for block in iter(lambda: fh.read(blocksize), b""):
+        if len(block) >= window:
+            tail = block[-window:]
+        else:
+            tail = (tail + block)[-window:]
+    return last_line(tail)
 
-zip_flag = False
+# zstd stream reader (zstandard module), frames of pzstd dumps included
+def zstd_open(fh):
+    return zstandard.ZstdDecompressor().stream_reader(fh, read_across_frames=True)
 
-try:
+# decompression backends by magic bytes: name, magic, python opener, external commands
+backends = [
+    ("gzip", b"\x1f\x8b", gzip.open, [["pigz", "-dc"], ["gzip", "-dc"]]),
+    ("bzip2", b"BZh", bz2.open, [["lbzip2", "-dc"], ["bzip2", "-dc"]]),
+    ("xz", b"\xfd7zXZ\x00", lzma.open, [["xz", "-dc", "-T0"]]),
+    ("zstd", b"\x28\xb5\x2f\xfd", zstd_open if zstandard else None, [["zstd", "-dc"]])
+]
+zstd_errors = (zstandard.ZstdError,) if zstandard else ()
 
-    for filename in os.listdir(args.directory):
-        filepath = os.path.join(args.directory, filename)
-        if os.path.isfile(filepath):
-
-            filesize = os.path.getsize(filepath)
-            zip_flag = False
-            
-            if filesize == 0:
+# read a dump file decompressed by the backend matching its magic bytes, with
+# file_reader for plain files and stream_reader for decompressed streams,
+# None on read or decompression error
+def read_dump(filepath, filename, stream_reader, file_reader):
+    try:
+        with open(filepath, 'rb') as fh:
+            magic = fh.read(6)
+            fh.seek(0)
+            for name, backend_magic, opener, commands in backends:
+                if magic.startswith(backend_magic):
+                    break
+            else:
                 if args.verbose:
-                    print("Empty file: ", filepath)
+                    print("SQL file detected: ", filename)
+                return file_reader(fh)
+
+            if args.verbose:
+                print("%s file detected: %s" % (name, filename))
+
+            # external decompressor first with --external, or without python module
+            command = None
+            if args.external or opener is None:
+                for candidate in commands:
+                    if shutil.which(candidate[0]):
+                        command = candidate
+                        break
 
-            elif re_include and not re_include.match(filename):
+            if command:
                 if args.verbose:
-                    print("File excluded: ", filename)
+                    print("using %s" % command[0])
+                process = subprocess.Popen(command + [filepath], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                with process.stdout:
+                    result = stream_reader(process.stdout)
+                if process.wait() != 0:
+                    if args.verbose:
+                        print("%s error on %s" % (command[0], filename))
+                    return None
+                return result
 
-            elif not re_database.search(filename):
+            if opener is None:
                 if args.verbose:
-                    print("Not configured database")
+                    print("no %s decompressor available" % name)
+                return None
+
+            if args.verbose:
+                print("using %s python module" % name)
+            with opener(fh) as stream:
+                return stream_reader(stream)
 
+    except (EOFError, OSError, lzma.LZMAError) + zstd_errors as eh:
+        if args.verbose:
+            print("read error on %s: %s" % (filename, eh))
+        return None
+
+# one pass over a whole dump, complete lines block by block (mysqldump
+# extended inserts are bounded by net_buffer_length): CREATE TABLE,
+# INSERT statements and rows per table, INSERT lines not ended by ";"
+# returns (last line, {table: [creates, inserts, rows]}, truncated statements)
+def scan_stream(fh, blocksize=1048576):
+    tables = {}
+    truncated = 0
+    # blocks start with the newline ending the previous one: statements
+    # are found by "\n" prefixed literals, much faster than a multiline "^"
+    block = remainder = b"\n"
+    for data in iter(lambda: fh.read(blocksize), b""):
+        block = remainder + data
+        end = block.rfind(b"\n")
+        remainder = block[end:]
+        for match in re_statement.finditer(block, 0, end):
+            table = tables.setdefault(match.group(2).decode('utf-8', 'replace'), [0, 0, 0])
+            if match.group(1) == b"CREATE TABLE":
+                table[0] += 1
             else:
-                if re_gzip.match(filename):
-                    zip_flag = True
-                    
-                    if args.verbose:
-                        print("gzip file detected: ", filename)
-
-                    if args.zcat:
-                        if args.verbose:
-                            print("using zcat")
-
-                        lastline = subprocess.check_output(
-                            "zcat %s/%s | tail -1" % (
-                                args.directory, filename
-                            ),
-                            shell=True
-                        ).decode()
-                    else:
-                        if args.verbose:
-                            print("using gzip python module")
-
-                        fh = gzip.open(filepath)
-                elif re_sql.match(filename):
-                    if args.verbose:
-                        print("SQL file detected: ", filename)
-                    fh = open(filepath, 'rb')
-
-                if (zip_flag and not args.zcat) or not zip_flag:
-                    fh.seek(-2, 2)  # Jump to the second last byte.
-                    while fh.read(1) != b"\n":  # Until EOL is found...
-                        fh.seek(-2, 1)  # ...jump back the read byte plus one more.
-                    lastline = fh.readline().decode()  # Read last line.
-
-                match = re_dump.match(lastline)
-                if match:
-                    backupdate = datetime.datetime.strptime(match.group(1),
-                                                            '%Y-%m-%d %H:%M:%S')
-                    backupage = datetime.datetime.now() - backupdate
-
-                    if backupdate > lastbackupdate:
-                        lastbackupdate = backupdate
-                        lastbackupsize = filesize
-                        lastbackupage = backupage
+                line_end = block.find(b"\n", match.end())
+                table[1] += 1
+                # rows separated by "),(" in extended inserts
+                table[2] += block.count(b"),(", match.end(), line_end) + 1
+                if block[line_end - 1:line_end] != b";":
+                    truncated += 1
+    if re_statement.match(remainder):
+        truncated += 1
+    return last_line(block), tables, truncated
 
-                    if args.verbose:
-                        print("backupdate: ", backupdate.isoformat())
-                        print("dump ok (size %s, date %s): %s" % (
-                            sizeof_fmt(filesize), backupdate, lastline
-                        ))
+# verification result of a dump file: last line, with deep statements per table
+def verify_dump(filepath, filename, deep):
+    if deep:
+        result = read_dump(filepath, filename, scan_stream, scan_stream)
+        if result is None:
+            return {"lastline": "", "tables": {}, "truncated": 1}
+        lastline, tables, truncated = result
+        return {"lastline": lastline.decode('utf-8', 'replace'), "tables": tables, "truncated": truncated}
+
+    lastline = read_dump(filepath, filename, tail_stream, tail_file)
+    if lastline is None:
+        return {"lastline": ""}
+    return {"lastline": lastline.decode('utf-8', 'replace')}
+
+# cache key of a dump file, changes when the file is replaced or modified
+def file_identity(filestat):
+    return [filestat.st_dev, filestat.st_ino, filestat.st_size, filestat.st_mtime_ns]
+
+# cache file of a directory and database
+def cache_path(cachedir, directory, database):
+    return os.path.join(cachedir, re.sub("[^A-Za-z0-9_.-]", "_", "%s_%s" % (directory.strip("/"), database)) + ".json")
+
+# load cache file, empty cache if missing or unreadable
+def load_cache(path):
+    try:
+        with open(path, "r") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+# save cache file atomically
+def save_cache(path, cache):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as fh:
+        json.dump(cache, fh)
+    os.replace(path + ".tmp", path)
+
+# options of a database: command line options, overridden by its configuration section
+def database_options(config, name):
+    options = argparse.Namespace(**vars(args))
+    options.name = name
+    options.database = name
+    if config:
+        for option in ("database", "include"):
+            if config.has_option(name, option):
+                setattr(options, option, config.get(name, option))
+        for option in ("delayw", "delayc"):
+            if config.has_option(name, option):
+                setattr(options, option, config.getint(name, option))
+        for option in ("all", "deep"):
+            if config.has_option(name, option):
+                setattr(options, option, config.getboolean(name, option))
+    options.re_include = re.compile(options.include)
+    options.re_database = re.compile(options.database)
+    return options
+
+# check the dumps of a database, returns (return code, status line, perfdatas)
+def check_database(options, candidates):
+    limitbackupagec = datetime.timedelta(hours=options.delayc)
+    limitbackupagew = datetime.timedelta(hours=options.delayw)
+    lastbackupdate = datetime.datetime.strptime('1970-01-01', '%Y-%m-%d')
+    lastbackupentry = None
+
+    # verification results by file name
+    cache = {}
+    newcache = {}
+    if options.cachedir:
+        cachefile = cache_path(options.cachedir, args.directory, options.name)
+        cache = load_cache(cachefile)
+
+    # newest dumps first, without --all older dumps are not read once a valid one is found
+    candidates.sort(key=lambda candidate: candidate[1].st_mtime_ns, reverse=True)
+
+    results = {}
+    for filename, filestat in candidates:
+        entry = cache.get(filename)
+        if entry and entry["identity"] == file_identity(filestat) and (not options.deep or "tables" in entry):
+            if args.verbose:
+                print("cached result: ", filename)
+            results[filename] = entry
+
+    if options.all:
+        unread = [filename for filename, filestat in candidates if filename not in results]
+        # fork workers: the script has no __main__ guard, spawn or forkserver workers would run it again
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("fork")) as executor:
+            entries = executor.map(verify_dump, [os.path.join(args.directory, filename) for filename in unread], unread, [options.deep] * len(unread))
+            results.update(zip(unread, entries))
+
+    dumps = 0
+    invalid = 0
+    for filename, filestat in candidates:
+        filepath = os.path.join(args.directory, filename)
+        filesize = filestat.st_size
+        if filename not in results:
+            results[filename] = verify_dump(filepath, filename, options.deep)
+        entry = results[filename]
+        lastline = entry["lastline"]
+
+        match = re_dump.match(lastline)
+        if match and not entry.get("truncated"):
+            dumps += 1
+            backupdate = datetime.datetime.strptime(match.group(1),
+                                                    '%Y-%m-%d %H:%M:%S')
+            backupage = datetime.datetime.now() - backupdate
+
+            if backupdate > lastbackupdate:
+                lastbackupdate = backupdate
+                lastbackupsize = filesize
+                lastbackupage = backupage
+                lastbackupentry = entry
+
+            if args.verbose:
+                print("backupdate: ", backupdate.isoformat())
+                print("dump ok (size %s, date %s): %s" % (
+                    sizeof_fmt(filesize), backupdate, lastline
+                ))
+                for table, (creates, inserts, rows) in sorted(entry.get("tables", {}).items()):
+                    print("table %s: %d create, %d inserts, %d rows" % (table, creates, inserts, rows))
+
+            if not options.all:
+                if args.verbose:
+                    print("newest valid dump found, older dumps not read")
+                break
+        else:
+            invalid += 1
+            if args.verbose:
+                if entry.get("truncated"):
+                    print("ERROR dump, %d truncated statements: %s" % (entry["truncated"], filepath))
                 else:
-                    if args.verbose:
-                        print("ERROR dump: ", filepath)
+                    print("ERROR dump: ", filepath)
 
-                if (zip_flag and not args.zcat) or not zip_flag:
-                    fh.close()
+    # dumps read or still cached, entries of deleted dumps are not kept
+    for filename, filestat in candidates:
+        if filename in results:
+            newcache[filename] = dict(results[filename], identity=file_identity(filestat))
+
+    if options.cachedir:
+        save_cache(cachefile, newcache)
+
+    if lastbackupentry is None:
+        if args.verbose:
+            print("ERROR: no valid backup found")
+        return 2, "ERROR %s no valid backup found (%d invalid)" % (options.name, invalid), ""
 
     if lastbackupage > limitbackupagec:
         if args.verbose:
             print("ERROR: last backup out of date")
-        print("ERROR ", end='')
         cr = 2
     elif lastbackupage > limitbackupagew:
         if args.verbose:
             print("WARNING: last backup out of date")
-        print("WARNING ", end='')
+        cr = 1
+    elif invalid and options.all:
+        if args.verbose:
+            print("WARNING: %d invalid dumps" % invalid)
         cr = 1
     else:
         if args.verbose:
             print("last backup OK")
-        print("OK ", end='')
         cr = 0
 
-    print("%s last backup date: %s, age: %s, size: %s | size=%d" %
-          (
-              args.database,
-              lastbackupdate.isoformat(),
-              iso8601(lastbackupage),
-              sizeof_fmt(lastbackupsize),
-              lastbackupsize
-          ),
-          end=''
-          )
+    status_line = "%s %s last backup date: %s, age: %s, size: %s" % (
+        status_names[cr],
+        options.name,
+        lastbackupdate.isoformat(),
+        iso8601(lastbackupage),
+        sizeof_fmt(lastbackupsize)
+    )
+    perfdatas = "size=%d" % lastbackupsize
+
+    if options.all:
+        perfdatas += " dumps=%d invalid=%d" % (dumps, invalid)
+
+    if options.deep:
+        tables = lastbackupentry.get("tables", {})
+        perfdatas += " tables=%d" % len(tables)
+        for table, (creates, inserts, rows) in sorted(tables.items()):
+            perfdatas += " rows_%s=%d" % (re.sub("[^A-Za-z0-9_]", "_", table), rows)
+
+    return cr, status_line, perfdatas
+
+status_names = {0: "OK", 1: "WARNING", 2: "ERROR"}
+
+re_dumpfile = re.compile(".*\.(sql|gz|bz2|xz|zst)$")
+re_dump = re.compile("^-- Dump completed on (.*)$")
+re_statement = re.compile(b"\n(CREATE TABLE|INSERT INTO) `([^`]*)`")
+
+cr = 2
+
+try:
+
+    config = None
+    databases = args.database
+    if args.config:
+        config = configparser.ConfigParser(interpolation=None)
+        config.read_file(open(args.config))
+        databases = [database.strip() for database in config.get("general", "databases").split(",")]
+
+    databases_options = [database_options(config, database) for database in databases]
+    buckets = dict((options.name, []) for options in databases_options)
+
+    # one directory scan, each dump goes to the bucket of every matching database
+    for filename in os.listdir(args.directory):
+        filepath = os.path.join(args.directory, filename)
+        try:
+            filestat = os.stat(filepath)
+        except FileNotFoundError:
+            continue
+        if stat.S_ISREG(filestat.st_mode):
+
+            if filestat.st_size == 0:
+                if args.verbose:
+                    print("Empty file: ", filepath)
+
+            elif not re_dumpfile.match(filename):
+                if args.verbose:
+                    print("Not a dump file: ", filename)
+
+            else:
+                matched = False
+                for options in databases_options:
+                    if options.re_include.match(filename) and options.re_database.search(filename):
+                        buckets[options.name].append((filename, filestat))
+                        matched = True
+                if args.verbose and not matched:
+                    print("Not configured database or excluded: ", filename)
+
+    results = [(options.name,) + check_database(options, buckets[options.name]) for options in databases_options]
+
+    if len(results) == 1 and not args.config:
+        name, cr, status_line, perfdatas = results[0]
+        if perfdatas:
+            print("%s | %s" % (status_line, perfdatas), end='')
+        else:
+            print(status_line, end='')
+    else:
+        cr = max(result[1] for result in results)
+        print("%s %s|%s" % (
+            status_names[cr],
+            " ".join("%s:%s" % (name, status_names[database_cr])
+                     for name, database_cr, status_line, perfdatas in results),
+            " ".join("%s_%s" % (name, perfdata)
+                     for name, database_cr, status_line, perfdatas in results
+                     for perfdata in perfdatas.split())
+        ), end='')
 
     if args.status:
         print(" status=%d" % cr)
     else:
         print("")
 
+    if len(results) > 1 or args.config:
+        for name, database_cr, status_line, perfdatas in results:
+            print("%s: %s" % (name, status_line))
+
 # except NameError:
 #     print("ERROR: no MySQL backup found")
 #     cr = 2
@@ -203,6 +487,10 @@ except FileNotFoundError as eh:
     print(eh.strerror, eh.filename)
     cr = 2
 
+except configparser.Error as eh:
+    print("error configuration file %s" % (args.config), eh.message)
+    cr = 2
+
 except:
     print("Unexpected error:", sys.exc_info())
     cr = 2
@@ -3,18 +3,27 @@
 # -----------------------------------------------------------------
 # check sqlite backups for Nagios
 # - perfdata for backup size
+# - integrity check, cached per backup file
 #
 # Copyright (C) 2016-2017, Christophe Fauchard
 # -----------------------------------------------------------------
 
-__version_info__ = (0, 1, 1, 'b1')
+__version_info__ = (0, 6, 0, 'b1')
 __version__ = '.'.join(map(str, __version_info__))
 
 import os
 import re
+import json
+import math
+import time
+import zlib
+import stat
+import struct
 import datetime
 import argparse
 import sqlite3
+import multiprocessing
+import concurrent.futures
 
 parser = argparse.ArgumentParser(
     description='check SQLite3 backups for Nagios with perfdatas for size')
@@ -39,12 +48,71 @@ parser.add_argument("--include",
                     type=str,
                     help="include regex",
                     default="\.*")
+parser.add_argument("--cachedir",
+                    type=str,
+                    help="cache directory, integrity checks of unchanged "
+                    "backups are not run again")
+parser.add_argument("--full",
+                    type=int,
+                    help="number of newest backups checked with "
+                    "integrity_check, older ones with quick_check "
+                    "(default: all)")
+parser.add_argument("--deadline",
+                    type=int,
+                    help="max seconds for the checks, unfinished checks are "
+                    "interrupted and the check returns UNKNOWN")
+parser.add_argument("--workers",
+                    type=int,
+                    help="processes running checks (default: number of cpus)",
+                    default=os.cpu_count())
+parser.add_argument("--immutable",
+                    type=int,
+                    help="backups unchanged for this many seconds are "
+                    "checked with immutable=1: no locks, no journal probing",
+                    default=300)
+parser.add_argument("--cachesize",
+                    type=int,
+                    help="page cache MB of the checks",
+                    default=256)
+parser.add_argument("--rotate",
+                    action='store_true',
+                    help="verify a slice of the backups at each run, page "
+                    "ranges checksummed again against their first read "
+                    "(needs --cachedir)")
+parser.add_argument("--budget",
+                    type=int,
+                    help="max pages read by --rotate at each run",
+                    default=262144)
+parser.add_argument("--rangepages",
+                    type=int,
+                    help="pages of a --rotate verified range",
+                    default=1024)
+parser.add_argument("--period",
+                    type=int,
+                    help="days to verify every range of every backup, "
+                    "warning when a range is older",
+                    default=30)
+parser.add_argument("--tables",
+                    action='store_true',
+                    help="pages, bytes and rows per table of the last backup, "
+                    "shrink compared with the previous backup")
+parser.add_argument("--shrinkw",
+                    type=int,
+                    help="warning when a table shrinks by this percent",
+                    default=10)
+parser.add_argument("--shrinkc",
+                    type=int,
+                    help="critical when a table shrinks by this percent",
+                    default=50)
 parser.add_argument('directory',
                     help="SQLite backup directory")
 parser.add_argument('database',
                     help="SQLite database name")
 args = parser.parse_args()
 
+if args.rotate and not args.cachedir:
+    parser.error("--rotate needs --cachedir")
+
 
 def iso8601(value):
     # split seconds to larger units
@@ -90,26 +158,280 @@ def sizeof_fmt(num, suffix='B'):
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
 
+def file_identity(filepath, filestat):
+    # file identity and database header: file change counter
+    # (bytes 24-27) and database size in pages (bytes 28-31)
+    with open(filepath, "rb") as fh:
+        header = fh.read(100)
+    if len(header) == 100 and header.startswith(b"SQLite format 3\x00"):
+        change_counter, page_count = struct.unpack(">II", header[24:32])
+    else:
+        change_counter = page_count = None
+    return [filestat.st_dev, filestat.st_ino, filestat.st_size,
+            filestat.st_mtime_ns, change_counter, page_count]
+
+
+def verify_connect(filepath, immutable):
+    # read only connection tuned for verification I/O: immutable backups
+    # are read without locks or journal probing, through a memory map
+    # (capped by SQLite to its max mmap size) and a large page cache
+    uri = "file:" + filepath + "?mode=ro"
+    if immutable:
+        uri += "&immutable=1"
+    conn = sqlite3.connect(uri, uri=True)
+    conn.execute("pragma mmap_size=%d;" % os.path.getsize(filepath))
+    conn.execute("pragma cache_size=%d;" % -(args.cachesize * 1024))
+    return conn
+
+
+def integrity_check(filepath, pragma, deadline, immutable):
+    # ("ok" or the check messages, seconds), None instead of the messages
+    # when interrupted at the deadline
+    start = time.perf_counter()
+    try:
+        conn = verify_connect(filepath, immutable)
+        try:
+            if deadline:
+                conn.set_progress_handler(lambda: time.time() > deadline,
+                                          10000)
+            rows = [row[0] for row in conn.execute("pragma %s;" % pragma)]
+        finally:
+            conn.close()
+    except sqlite3.OperationalError as eh:
+        if deadline and time.time() > deadline:
+            return None, time.perf_counter() - start
+        return str(eh), time.perf_counter() - start
+    except sqlite3.DatabaseError as eh:
+        return str(eh), time.perf_counter() - start
+    return "\n".join(rows), time.perf_counter() - start
+
+
+def btree_stats(filepath, roots, deadline):
+    # b-tree walk without dbstat: [(name, pages, bytes, leaf cells)],
+    # overflow pages not counted, None when interrupted at the deadline
+    stats = []
+    with open(filepath, "rb") as fh:
+        header = fh.read(100)
+        pagesize = struct.unpack(">H", header[16:18])[0]
+        if pagesize == 1:
+            pagesize = 65536
+        pagecount = os.path.getsize(filepath) // pagesize
+        for name, rootpage in roots:
+            pages = cells = 0
+            seen = set()
+            stack = [rootpage]
+            while stack:
+                if deadline and time.time() > deadline:
+                    return None
+                pageno = stack.pop()
+                if pageno in seen or not 0 < pageno <= pagecount:
+                    continue
+                seen.add(pageno)
+                fh.seek((pageno - 1) * pagesize)
+                page = fh.read(pagesize)
+                offset = 100 if pageno == 1 else 0
+                pagetype = page[offset]
+                ncell = struct.unpack(">H", page[offset + 3:offset + 5])[0]
+                pages += 1
+                # leaf table and index pages
+                if pagetype in (0x0d, 0x0a):
+                    cells += ncell
+                # interior pages: left child of each cell, right most child
+                elif pagetype in (0x05, 0x02):
+                    stack.append(struct.unpack(
+                        ">I", page[offset + 8:offset + 12])[0])
+                    for cell in range(ncell):
+                        start = offset + 12 + 2 * cell
+                        pointer = struct.unpack(">H", page[start:start + 2])[0]
+                        stack.append(struct.unpack(
+                            ">I", page[pointer:pointer + 4])[0])
+            stats.append((name, pages, pages * pagesize, cells))
+    return stats
+
+
+def table_stats(filepath, deadline, immutable):
+    # {table: [pages, bytes, rows]} in one pass over dbstat (b-tree walk
+    # when not compiled in), indexes counted with their table, rows from
+    # the leaf cells of the table b-tree, sqlite_ internal b-trees (schema,
+    # sequence, statistics) left out. None when interrupted at the deadline
+    conn = verify_connect(filepath, immutable)
+    try:
+        if deadline:
+            conn.set_progress_handler(lambda: time.time() > deadline, 10000)
+        owners = dict(conn.execute("select name, tbl_name from sqlite_master "
+                                   "where rootpage > 0;"))
+        try:
+            btrees = conn.execute(
+                "select name, count(*), sum(pgsize), "
+                "sum(case when pagetype = 'leaf' then ncell else 0 end) "
+                "from dbstat group by name;").fetchall()
+        except sqlite3.OperationalError:
+            if deadline and time.time() > deadline:
+                raise
+            btrees = btree_stats(filepath, conn.execute(
+                "select name, rootpage from sqlite_master "
+                "where rootpage > 0;").fetchall(), deadline)
+    except sqlite3.OperationalError:
+        if deadline and time.time() > deadline:
+            return None
+        raise
+    finally:
+        conn.close()
+    if btrees is None:
+        return None
+
+    tables = {}
+    for name, pages, size, cells in btrees:
+        table = owners.get(name, name)
+        if table.startswith("sqlite_"):
+            continue
+        stats = tables.setdefault(table, [0, 0, 0])
+        stats[0] += pages
+        stats[1] += size
+        if table == name:
+            stats[2] += cells
+    return tables
+
+
+def table_shrink(current, previous):
+    # (largest shrink percent of a table between two backups, table),
+    # on rows or on bytes for tables without rows, a missing table
+    # shrinks by 100%
+    shrink = 0
+    shrinktable = None
+    for table, (pages, size, rows) in previous.items():
+        pages_after, size_after, rows_after = current.get(table, [0, 0, 0])
+        before, after = (rows, rows_after) if rows else (size, size_after)
+        if before and (before - after) * 100.0 / before > shrink:
+            shrink = (before - after) * 100.0 / before
+            shrinktable = table
+    return shrink, shrinktable
+
+
+def verify_ranges(backups, cache, deadline):
+    # rotating verification of the backups with a valid integrity check:
+    # ranges verified longest ago (never verified first) are read within
+    # the pages budget, a checksum differing from the first read of a
+    # range is bit rot. Returns (ranges verified within the period ratio,
+    # age in seconds of the oldest verification, checksum mismatches)
+    now = time.time()
+    regions = []
+    for filename, filestat in backups:
+        entry = cache.get(filename)
+        if not entry or entry["integrity"] != "ok":
+            continue
+        if "ranges" not in entry:
+            with open(os.path.join(args.directory, filename), "rb") as fh:
+                header = fh.read(100)
+            # page size: header bytes 16-17, 1 stands for 65536
+            pagesize = struct.unpack(">H", header[16:18])[0]
+            entry["pagesize"] = 65536 if pagesize == 1 else pagesize
+            count = math.ceil(filestat.st_size /
+                              (entry["pagesize"] * args.rangepages))
+            entry["ranges"] = [[None, None] for index in range(count)]
+        for index, (checksum, verified) in enumerate(entry["ranges"]):
+            regions.append((verified or 0, filestat.st_ctime, filename, index))
+    regions.sort()
+
+    budget = args.budget
+    mismatches = 0
+    for verified, created, filename, index in regions:
+        if budget < args.rangepages or (deadline and time.time() > deadline):
+            break
+        entry = cache[filename]
+        rangesize = entry["pagesize"] * args.rangepages
+        try:
+            with open(os.path.join(args.directory, filename), "rb") as fh:
+                fh.seek(index * rangesize)
+                checksum = zlib.crc32(fh.read(rangesize))
+        except OSError as eh:
+            # unreadable range, as damaged as a changed one
+            checksum = str(eh)
+        budget -= args.rangepages
+        if entry["ranges"][index][0] not in (None, checksum):
+            if args.verbose:
+                print("%s: checksum mismatch, pages %d-%d" % (
+                    filename, index * args.rangepages,
+                    (index + 1) * args.rangepages - 1))
+            entry["integrity"] = "checksum mismatch, pages %d-%d" % (
+                index * args.rangepages, (index + 1) * args.rangepages - 1)
+            mismatches += 1
+        entry["ranges"][index] = [checksum, now]
+
+    # coverage of the period and oldest verification, a range never
+    # verified dates from its backup
+    ranges = 0
+    verified_ranges = 0
+    oldest = now
+    for filename, filestat in backups:
+        entry = cache.get(filename)
+        if not entry or "ranges" not in entry:
+            continue
+        for checksum, verified in entry["ranges"]:
+            ranges += 1
+            if verified and verified >= now - args.period * 86400:
+                verified_ranges += 1
+            oldest = min(oldest, verified or filestat.st_ctime)
+    if not ranges:
+        return 1.0, 0, mismatches
+    return verified_ranges / ranges, now - oldest, mismatches
+
+
+def cache_path(cachedir, directory, database):
+    return os.path.join(
+        cachedir,
+        re.sub("[^A-Za-z0-9_.-]", "_",
+               "%s_%s" % (directory.strip("/"), database)) + ".json")
+
+
+def load_cache(path):
+    try:
+        with open(path, "r") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(path, cache):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as fh:
+        json.dump(cache, fh)
+    os.replace(path + ".tmp", path)
+
+
 limitbackupagec = datetime.timedelta(hours=args.delayc)
 limitbackupagew = datetime.timedelta(hours=args.delayw)
+deadline = time.time() + args.deadline if args.deadline else None
 
 re_sql = re.compile(".*\.sqlite$")
 re_include = re.compile(args.include)
 re_database = re.compile(args.database)
 
 lastbackupdate = datetime.datetime.strptime('1970-01-01', '%Y-%m-%d')
+errors = 0
+unchecked = 0
+checked_bytes = 0
+checked_seconds = 0
+
+# integrity results by file name, entries of deleted files are not kept
+cache = {}
+newcache = {}
+if args.cachedir:
+    cachefile = cache_path(args.cachedir, args.directory, args.database)
+    cache = load_cache(cachefile)
 
 try:
 
+    backups = []
     for filename in os.listdir(args.directory):
         filepath = os.path.join(args.directory, filename)
-        if os.path.isfile(filepath):
+        try:
+            filestat = os.stat(filepath)
+        except FileNotFoundError:
+            continue
+        if stat.S_ISREG(filestat.st_mode):
 
-            filesize = os.path.getsize(filepath)
-            filedate = datetime.datetime.fromtimestamp(
-                os.path.getctime(filepath))
-
-            if filesize == 0:
+            if filestat.st_size == 0:
                 if args.verbose:
                     print("Empty file: ", filepath)
 
@@ -121,63 +443,229 @@ try:
                 if args.verbose:
                     print("Not configured database")
 
+            elif re_sql.match(filename):
+                if args.verbose:
+                    print("SQLite file detected: ", filename)
+                backups.append((filename, filestat))
+
+    # newest backups first: integrity_check for the --full newest ones,
+    # quick_check for the others, submitted first to the workers
+    backups.sort(key=lambda backup: backup[1].st_ctime, reverse=True)
+
+    # fork workers: the script has no __main__ guard, spawn or
+    # forkserver workers would run it again
+    checks = {}
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.workers,
+            mp_context=multiprocessing.get_context("fork")) as executor:
+        for rank, (filename, filestat) in enumerate(backups):
+            filepath = os.path.join(args.directory, filename)
+            identity = file_identity(filepath, filestat)
+            if args.full is None or rank < args.full:
+                pragma = "integrity_check"
             else:
-                if re_sql.match(filename):
-                    if args.verbose:
-                        print("SQLite file detected: ", filename)
-
-                    # Try to open SQLite database
-                    conn = sqlite3.connect("file:" +
-                                           filepath +
-                                           "?mode=ro",
-                                           uri=True)
-
-                    # SQLite database integrity check
-                    for row in conn.execute("pragma integrity_check;"):
-                        if args.verbose:
-                            print("Integrity check: " + row[0])
-                    conn.close()
-                        
-                    backupdate = filedate
-                    backupage = datetime.datetime.now() - backupdate
-
-                    if backupdate > lastbackupdate:
-                        lastbackupdate = backupdate
-                        lastbackupsize = filesize
-                        lastbackupage = backupage
+                pragma = "quick_check"
+
+            # a cached integrity_check result also stands for a quick_check
+            entry = cache.get(filename)
+            if entry and entry["identity"] == identity and \
+                    pragma in (entry["pragma"], "quick_check"):
+                checks[filename] = (identity, entry["pragma"], entry)
+            elif identity[4] is None:
+                checks[filename] = (identity, pragma, {
+                    "pragma": pragma,
+                    "integrity": "file is not a database"
+                })
+            else:
+                checks[filename] = (identity, pragma, executor.submit(
+                    integrity_check, filepath, pragma, deadline,
+                    time.time() - filestat.st_mtime > args.immutable))
+
+        for filename, filestat in backups:
+            filesize = filestat.st_size
+            filedate = datetime.datetime.fromtimestamp(filestat.st_ctime)
+            identity, pragma, check = checks[filename]
+
+            if isinstance(check, dict):
+                integrity = check["integrity"]
+                if args.verbose:
+                    print("%s %s (cached): %s" % (filename, pragma,
+                                                  integrity))
+                newcache[filename] = dict(check, identity=identity)
+            else:
+                integrity, seconds = check.result()
+                if integrity is not None:
+                    checked_bytes += filesize
+                    checked_seconds += seconds
+                if args.verbose:
+                    print("%s %s: %s (%.1fMB/s)" % (
+                        filename, pragma, integrity or "interrupted",
+                        filesize / 1024**2 / seconds))
+                if integrity is not None:
+                    newcache[filename] = {"identity": identity,
+                                          "pragma": pragma,
+                                          "integrity": integrity}
+
+            if integrity is None:
+                unchecked += 1
+            elif integrity != "ok":
+                errors += 1
 
+            backupdate = filedate
+            backupage = datetime.datetime.now() - backupdate
+
+            if backupdate > lastbackupdate:
+                lastbackupdate = backupdate
+                lastbackupsize = filesize
+                lastbackupage = backupage
+                lastbackupintegrity = integrity
+                lastbackupfilename = filename
+
+            if args.verbose:
+                print("backupdate: ", backupdate.isoformat())
+                print("backup SQLite %s (size %s, date %s)" %
+                      ({None: "unchecked", "ok": "ok"}.get(integrity,
+                                                           "corrupted"),
+                       sizeof_fmt(filesize), backupdate))
+
+    if args.rotate:
+        coverage, oldest, mismatches = verify_ranges(backups, newcache,
+                                                     deadline)
+        errors += mismatches
+        lastbackupintegrity = newcache.get(lastbackupfilename, {}).get(
+            "integrity", lastbackupintegrity)
+        if args.verbose:
+            print("verified ranges: %.1f%%, oldest verification: %s" % (
+                coverage * 100, datetime.timedelta(seconds=int(oldest))))
+
+    if args.tables:
+        # last backup and newest earlier backup passing its integrity
+        # check, statistics cached with the integrity (read again when
+        # cached with the sqlite_ internal b-trees), statistics
+        # interrupted at the deadline count as unchecked
+        tables = []
+        for rank, (filename, filestat) in enumerate(backups):
+            entry = newcache.get(filename, {})
+            if rank and entry.get("integrity") != "ok":
+                continue
+            if "tables" in entry and not any(
+                    table.startswith("sqlite_") for table in entry["tables"]):
+                stats = entry["tables"]
+            else:
+                try:
+                    stats = table_stats(
+                        os.path.join(args.directory, filename), deadline,
+                        time.time() - filestat.st_mtime > args.immutable)
+                except sqlite3.DatabaseError as eh:
+                    if args.verbose:
+                        print("%s table statistics: %s" % (filename, eh))
+                    if rank:
+                        continue
+                    stats = {}
+                if stats is None:
                     if args.verbose:
-                        print("backupdate: ", backupdate.isoformat())
-                        print("backup SQLite ok (size %s, date %s)" %
-                              (sizeof_fmt(filesize), backupdate))
-                   
-    if lastbackupage > limitbackupagec:
+                        print("%s table statistics: interrupted" % filename)
+                    unchecked += 1
+                    break
+                if filename in newcache:
+                    newcache[filename]["tables"] = stats
+            tables.append(stats)
+            if len(tables) == 2:
+                if args.verbose:
+                    print("table shrink from ", filename)
+                break
+        lasttables = tables[0] if tables else {}
+        shrink, shrinktable = table_shrink(lasttables, tables[1]) \
+            if len(tables) > 1 else (0, None)
+        if args.verbose:
+            for table, (pages, size, rows) in sorted(lasttables.items()):
+                print("table %s: %d pages, %s, %d rows" % (
+                    table, pages, sizeof_fmt(size), rows))
+            if shrinktable:
+                print("largest shrink: %s %.1f%%" % (shrinktable, shrink))
+
+    if args.cachedir:
+        save_cache(cachefile, newcache)
+
+    if lastbackupintegrity not in ("ok", None):
+        if args.verbose:
+            print("ERROR: last backup integrity check failed")
+        print("ERROR ", end='')
+        cr = 2
+    elif lastbackupage > limitbackupagec:
         if args.verbose:
             print("ERROR: last backup out of date")
         print("ERROR ", end='')
         cr = 2
+    elif args.tables and shrink >= args.shrinkc:
+        if args.verbose:
+            print("ERROR: table %s shrank by %.1f%%" % (shrinktable, shrink))
+        print("ERROR ", end='')
+        cr = 2
+    elif unchecked:
+        if args.verbose:
+            print("UNKNOWN: %d backups not checked before the deadline" %
+                  unchecked)
+        print("UNKNOWN ", end='')
+        cr = 3
     elif lastbackupage > limitbackupagew:
         if args.verbose:
             print("WARNING: last backup out of date")
         print("WARNING ", end='')
         cr = 1
+    elif args.tables and shrink >= args.shrinkw:
+        if args.verbose:
+            print("WARNING: table %s shrank by %.1f%%" % (shrinktable, shrink))
+        print("WARNING ", end='')
+        cr = 1
+    elif args.rotate and oldest > args.period * 86400:
+        if args.verbose:
+            print("WARNING: ranges not verified for more than %d days" %
+                  args.period)
+        print("WARNING ", end='')
+        cr = 1
+    elif errors:
+        if args.verbose:
+            print("WARNING: %d older backups failed integrity check" % errors)
+        print("WARNING ", end='')
+        cr = 1
     else:
         if args.verbose:
             print("last backup OK")
         print("OK ", end='')
         cr = 0
 
-    print("%s last backup date: %s, age: %s, size: %s | size=%d" %
+    print("%s last backup date: %s, age: %s, size: %s%s | "
+          "size=%d errors=%d unchecked=%d" %
           (
               args.database,
               lastbackupdate.isoformat(),
               iso8601(lastbackupage),
               sizeof_fmt(lastbackupsize),
-              lastbackupsize
+              ", no valid previous backup for table shrink"
+              if args.tables and len(tables) < 2 else "",
+              lastbackupsize,
+              errors,
+              unchecked
           ),
           end=''
           )
 
+    if args.rotate:
+        print(" coverage=%.1f%% oldest=%ds" % (coverage * 100, oldest),
+              end='')
+
+    if args.tables:
+        print(" shrink=%.1f%%" % shrink, end='')
+        for table, (pages, size, rows) in sorted(lasttables.items()):
+            label = re.sub("[^A-Za-z0-9_]", "_", table)
+            print(" rows_%s=%d bytes_%s=%dB" % (label, rows, label, size),
+                  end='')
+
+    if checked_seconds:
+        print(" throughput=%.1f" % (checked_bytes / 1024**2 /
+                                    checked_seconds), end='')
+
     if args.status:
         print(" status=%d" % cr)
     else: